@@ -0,0 +1,112 @@
+import asyncio
+import threading
+import time
+
+from metrics import registry
+from ttl_cache import TTLCache
+
+# Token buckets are dropped after this long without a request, when they are full again anyway
+IDLE_BUCKET_TTL = 10 * 60
+
+in_flight = registry.gauge("admission_in_flight", "Requests being served by this worker")
+limits = registry.gauge("admission_limit", "Configured admission and rate limits", ("limit",))
+shed = registry.counter("admission_shed_total", "Requests turned away instead of queued", ("route", "reason", "response"))
+
+
+class Rejected(Exception):
+    """The request was turned away; retry_after is a hint in seconds."""
+
+    reason = "rejected"
+    status_code = 503
+
+    def __init__(self, detail, retry_after=1):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class Overloaded(Rejected):
+    reason = "overloaded"
+    status_code = 503
+
+
+class RateLimited(Rejected):
+    reason = "rate_limited"
+    status_code = 429
+
+
+class ConcurrencyLimiter:
+    """Caps the requests a worker serves at once.
+
+    A request that cannot start within wait seconds raises Overloaded, so a
+    burst is shed quickly instead of queueing behind Firestore and Storage
+    until every request in the queue times out. Requests are admitted once,
+    when they arrive, so one that started always runs to the end.
+    """
+
+    def __init__(self, limit, wait):
+        self.limit = limit
+        self.wait = wait
+        self.semaphore = asyncio.Semaphore(limit)
+        limits.set(limit, limit="max_in_flight")
+        limits.set(wait, limit="admission_wait_seconds")
+
+    async def acquire(self):
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.wait)
+        except asyncio.TimeoutError:
+            raise Overloaded("Too many requests in progress, try again shortly")
+        in_flight.inc()
+
+    def release(self):
+        in_flight.inc(-1)
+        self.semaphore.release()
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Take a token, returning 0, or return the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Per client token buckets: rate requests a second on average, up to burst at once.
+
+    Buckets are kept per worker, so with N workers a client can get up to N
+    times the rate when its requests are spread over all of them.
+    """
+
+    def __init__(self, rate, burst, maxsize=100000):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = TTLCache(ttl=IDLE_BUCKET_TTL, maxsize=maxsize)
+        self.lock = threading.Lock()
+        limits.set(rate, limit="rate_per_second")
+        limits.set(burst, limit="rate_burst")
+
+    def check(self, route, client):
+        """Raise RateLimited when client is over its limit for route."""
+        if not self.rate:
+            return
+        key = (route, client)
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+            wait = bucket.take()
+            self.buckets.set(key, bucket)
+        if wait:
+            raise RateLimited("Too many requests, slow down", retry_after=max(1, round(wait)))
@@ -0,0 +1,62 @@
+import os
+
+# "gcp" talks to Firestore, Cloud Storage and Firebase auth.
+# "memory" uses the in-process stand-ins from memory_backend (benchmarks, local runs).
+BACKEND = os.environ.get("TWITTER_BACKEND", "gcp")
+
+
+def use_memory():
+    return BACKEND == "memory"
+
+
+def firestore_client(project):
+    if use_memory():
+        import memory_backend
+        return memory_backend.firestore_client
+    from google.cloud import firestore
+    return firestore.Client(project=project)
+
+
+def storage_client(project, pool_size=None):
+    if use_memory():
+        import memory_backend
+        return memory_backend.storage_client
+    from google.cloud import storage
+    client = storage.Client(project=project)
+    if pool_size:
+        # The default pool keeps 10 connections, fewer than the threads that share the client
+        client._http.mount("https://", http_adapter(pool_size))
+    return client
+
+
+def http_adapter(pool_size):
+    import requests.adapters
+    return requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+
+
+def http_session(pool_size):
+    """A requests session with a connection pool sized for pool_size concurrent callers."""
+    import requests
+    session = requests.Session()
+    session.mount("https://", http_adapter(pool_size))
+    return session
+
+
+def cache_backend(url=None):
+    """The shared cache: Redis at url, or one cache per process when no url is set."""
+    import shared_cache
+    if use_memory():
+        import memory_backend
+        return shared_cache.RedisBackend(memory_backend.redis_client)
+    if not url:
+        return shared_cache.LocalBackend()
+    import redis
+    return shared_cache.RedisBackend(redis.Redis.from_url(url))
+
+
+def token_verifier(request):
+    if use_memory():
+        import memory_backend
+        return memory_backend.token_verifier
+    import firebase_auth
+    return firebase_auth.TokenVerifier(request)
@@ -0,0 +1,251 @@
+"""Endpoint benchmark and load test against the in-memory backend.
+
+Seeds synthetic users, follow graphs and tweets, drives the main routes
+concurrently and reports p50/p99 latency, throughput and Firestore/Storage
+RPCs per request. Run it from a checkout that has templates/ and static/:
+
+    python benchmark.py --users 500 --follows 50 --tweets 20 --requests 200
+
+Save a run with --json and pass it back with --baseline to fail (exit 1)
+when an endpoint starts issuing more RPCs or reading more documents.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+os.environ["TWITTER_BACKEND"] = "memory"
+# Nothing leaves the process, so any project and bucket name will do
+os.environ.setdefault("TWITTER_PROJECT", "benchmark")
+os.environ.setdefault("TWITTER_BUCKET", "benchmark-bucket")
+# Measure capacity, not the per-user rate limits
+os.environ.setdefault("TWITTER_RATE_LIMIT", "0")
+
+import httpx
+
+import follow_graph
+import main
+import memory_backend
+import timeline_store
+import tweet_search
+
+VOCABULARY = ("fastapi firestore python cloud storage timeline search tweet follow coffee "
+              "music travel football weekend launch deploy release bug fix latency cache").split()
+
+# Counters that are not RPCs themselves
+VOLUME_COUNTERS = ('firestore.docs_read', 'firestore.docs_written', 'storage.bytes_uploaded')
+
+PNG = (b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89"
+       b"\x00\x00\x00\rIDATx\x9cc\xf8\x0f\x00\x00\x01\x01\x00\x05\x18\xd8N\x00\x00\x00\x00IEND\xaeB`\x82")
+
+
+def user_id(index):
+    return "user{:06d}".format(index)
+
+
+def seed(db, users, follows, tweets, rng):
+    """Write users, follow edges and tweets the way the app itself would."""
+    users_ref = db.collection('twitter_user')
+    for index in range(users):
+        users_ref.document(user_id(index)).set({
+            "username": user_id(index),
+            "email": user_id(index) + "@bench.test",
+            "follower_count": 0,
+            "following_count": 0,
+            "profile_url": "",
+            "timeline_ready": True,
+        })
+
+    for index in range(users):
+        others = [other for other in range(users) if other != index]
+        for other in rng.sample(others, min(follows, len(others))):
+            follow_graph.follow(db, user_id(index), user_id(other))
+
+    start = datetime.utcnow() - timedelta(days=30)
+    for index in range(users):
+        author_id = user_id(index)
+        author_data = users_ref.document(author_id).get().to_dict()
+        for number in range(tweets):
+            text = " ".join(rng.choice(VOCABULARY) for _ in range(8))
+            tweet_data = {
+                "tweetText": text,
+                "username": author_id,
+                "email": author_id + "@bench.test",
+                "date": start + timedelta(minutes=rng.randrange(30 * 24 * 60)),
+                "search_terms": tweet_search.terms(text),
+            }
+            tweet_ref = users_ref.document(author_id).collection('tweets').document()
+            tweet_ref.set(tweet_data)
+            timeline_store.push_tweet(db, author_id, author_data, tweet_ref.id, tweet_data)
+
+
+def token_for(index):
+    return memory_backend.make_token(user_id(index), user_id(index) + "@bench.test")
+
+
+def scenarios(users, rng):
+    """Return (name, build) pairs; build(viewer) gives the request to send."""
+    follow_pairs = []
+
+    def follow(viewer):
+        target = rng.randrange(users)
+        follow_pairs.append((viewer, target))
+        return "POST", "/follow/" + user_id(target), {}
+
+    def unfollow(viewer):
+        if follow_pairs:
+            viewer, target = follow_pairs.pop()
+        else:
+            target = rng.randrange(users)
+        return "POST", "/unfollow/" + user_id(target), {"viewer": viewer}
+
+    return [
+        ("home", lambda viewer: ("GET", "/", {})),
+        ("profile", lambda viewer: ("GET", "/profile", {})),
+        ("user_profile", lambda viewer: ("GET", "/user_profile", {"params": {"user_id": user_id(rng.randrange(users))}})),
+        ("search", lambda viewer: ("POST", "/search", {"data": {"username": user_id(rng.randrange(users))[:6]}})),
+        ("tweet_list", lambda viewer: ("POST", "/tweetList", {"data": {"user": user_id(rng.randrange(users)), "tweet": rng.choice(VOCABULARY)}})),
+        ("tweet_list_all", lambda viewer: ("POST", "/tweetList", {"data": {"user": "all", "tweet": rng.choice(VOCABULARY)}})),
+        ("explore", lambda viewer: ("GET", "/explore", {})),
+        ("create_tweet", lambda viewer: ("POST", "/tweets", {"data": {"tweetText": " ".join(rng.sample(VOCABULARY, 6))},
+                                                              "files": {"image": ("bench.png", PNG, "image/png")}})),
+        ("follow", follow),
+        ("unfollow", unfollow),
+    ]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+async def run_scenario(client, build, users, requests, concurrency, rng):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one():
+        nonlocal errors
+        viewer = rng.randrange(users)
+        method, url, options = build(viewer)
+        viewer = options.pop("viewer", viewer)
+        headers = {"Cookie": "token=" + token_for(viewer)}
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.request(method, url, headers=headers, **options)
+            latencies.append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            errors += 1
+
+    memory_backend.reset_stats()
+    started = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(requests)])
+    elapsed = time.perf_counter() - started
+    counters = memory_backend.snapshot_stats()
+
+    # Cache round trips are reported apart from the Firestore and Storage RPCs they save
+    rpcs = sum(count for name, count in counters.items() if name not in VOLUME_COUNTERS and not name.startswith('cache.'))
+    cache_ops = sum(count for name, count in counters.items() if name.startswith('cache.'))
+    return {
+        "requests": requests,
+        "errors": errors,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "throughput": requests / elapsed,
+        "rpcs_per_request": rpcs / requests,
+        "docs_read_per_request": counters['firestore.docs_read'] / requests,
+        "docs_written_per_request": counters['firestore.docs_written'] / requests,
+        "cache_ops_per_request": cache_ops / requests,
+        "counters": dict(counters),
+    }
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    selected = set(args.only.split(",")) if args.only else None
+
+    results = {}
+    transport = httpx.ASGITransport(app=main.app)
+    # The transport does not send lifespan events, so start and stop the app's clients here
+    async with main.app.router.lifespan_context(main.app):
+        clients = main.app.state.resources
+        # Seed through the app's own caches, as its requests would
+        token = clients.use()
+        try:
+            seed(clients.firestore, args.users, args.follows, args.tweets, rng)
+        finally:
+            clients.reset(token)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            # Warm up caches before measuring
+            await client.get("/", headers={"Cookie": "token=" + token_for(0)})
+            for name, build in scenarios(args.users, rng):
+                if selected and name not in selected:
+                    continue
+                results[name] = await run_scenario(client, build, args.users, args.requests, args.concurrency, rng)
+    return results
+
+
+def report(results):
+    header = "{:<16} {:>8} {:>7} {:>9} {:>9} {:>10} {:>9} {:>10}".format(
+        "endpoint", "requests", "errors", "p50 ms", "p99 ms", "req/s", "rpcs/req", "reads/req")
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        print("{:<16} {:>8} {:>7} {:>9.2f} {:>9.2f} {:>10.1f} {:>9.2f} {:>10.2f}".format(
+            name, result["requests"], result["errors"], result["p50_ms"], result["p99_ms"],
+            result["throughput"], result["rpcs_per_request"], result["docs_read_per_request"]))
+
+
+def regressions(results, baseline, tolerance):
+    failures = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        for metric in ("rpcs_per_request", "docs_read_per_request"):
+            limit = previous[metric] * (1 + tolerance)
+            if result[metric] > limit:
+                failures.append("{} {} {:.2f} > {:.2f}".format(name, metric, result[metric], limit))
+    return failures
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=200, help="synthetic users to create")
+    parser.add_argument("--follows", type=int, default=20, help="accounts each user follows")
+    parser.add_argument("--tweets", type=int, default=10, help="tweets per user")
+    parser.add_argument("--requests", type=int, default=100, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=10, help="requests in flight at once")
+    parser.add_argument("--only", help="comma separated endpoints to run")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results file to compare RPC and read counts against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed growth over the baseline")
+    return parser.parse_args(argv)
+
+
+def cli(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+    report(results)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            failures = regressions(results, json.load(baseline_file), args.tolerance)
+        for failure in failures:
+            print("REGRESSION", failure)
+        if failures:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
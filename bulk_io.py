@@ -0,0 +1,220 @@
+"""Offline NDJSON import and export of users, their tweets and follow edges.
+
+Each line is one document, {"path": ..., "data": ...}, where path is
+twitter_user/<id> or twitter_user/<id>/{tweets,followers,followings}/<id>
+and timestamps are written as {"$date": "<ISO 8601>"}. A user's line is
+followed by their tweets, then their followers and followings, so the
+imported edges match the follower and following counts on the user
+document. Both directions save a checkpoint after every page or flush, so an
+interrupted run continues from it when started again with the same file:
+
+    python bulk_io.py export tweets.ndjson --checkpoint export.json
+    python bulk_io.py import tweets.ndjson --checkpoint import.json --max-ops 2000
+
+Materialized timelines are not part of the archive. Imported users have their
+timeline rebuilt from their follows on their next visit.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions
+
+import backends
+import follow_graph
+import timeline_store
+import tweet_search
+
+USERS = 'twitter_user'
+
+# Documents per query page when exporting
+PAGE_SIZE = 500
+
+# Users whose tweets are read at the same time when exporting
+EXPORT_WORKERS = 8
+
+# Writes queued in the BulkWriter before waiting for them and saving a checkpoint
+FLUSH_EVERY = 5000
+
+# Write rate the BulkWriter starts at and ramps up to
+MAX_OPS_PER_SECOND = 500
+
+# Attempts per document before the import gives up on it
+MAX_ATTEMPTS = 10
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {'$date': value.isoformat()}
+    raise TypeError("Cannot export a value of type " + type(value).__name__)
+
+
+def _decode(value):
+    if len(value) == 1 and '$date' in value:
+        return datetime.fromisoformat(value['$date'])
+    return value
+
+
+def dumps(path, data):
+    return json.dumps({'path': path, 'data': data}, default=_encode, sort_keys=True)
+
+
+def loads(line):
+    """Return (path, data) for one archive line."""
+    record = json.loads(line, object_hook=_decode)
+    return record['path'], record['data']
+
+
+def read_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as checkpoint:
+        return json.load(checkpoint)
+
+
+def write_checkpoint(path, state):
+    if not path:
+        return
+    # Write then rename, so a crash never leaves a half written checkpoint
+    with open(path + '.tmp', 'w') as checkpoint:
+        json.dump(state, checkpoint)
+    os.replace(path + '.tmp', path)
+
+
+def pages(query, page_size=PAGE_SIZE, after=None):
+    """Yield the documents of query in ID order, one page per RPC, starting after the ID after."""
+    query = query.order_by('__name__').limit(page_size)
+    while True:
+        page = list((query.start_after({'__name__': after}) if after else query).stream())
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        after = page[-1].id
+
+
+def user_documents(db, user_id):
+    """Return the pages of a user's tweets and follow edges as an iterator, with only the first page read yet."""
+    refs = (timeline_store.tweets_ref(db, user_id), follow_graph.followers_ref(db, user_id),
+            follow_graph.followings_ref(db, user_id))
+    document_pages = itertools.chain.from_iterable(pages(ref) for ref in refs)
+    return itertools.chain([next(document_pages, [])], document_pages)
+
+
+def export(db, output_path, checkpoint_path=None, workers=EXPORT_WORKERS):
+    """Write every user, their tweets and follow edges to output_path and return the number of documents."""
+    state = read_checkpoint(checkpoint_path)
+    documents = state.get('documents', 0)
+    # Drop anything written after the last checkpoint; it is exported again
+    mode = 'r+' if state else 'w'
+    with open(output_path, mode) as output, ThreadPoolExecutor(workers) as pool:
+        output.seek(state.get('offset', 0))
+        output.truncate()
+        for page in pages(db.collection(USERS), after=state.get('after')):
+            # First pages of tweets are read for several users at once, but written in
+            # user order; a user's later pages are read and written one at a time
+            for user, user_pages in zip(page, pool.map(lambda user: user_documents(db, user.id), page)):
+                output.write(dumps(user.reference.path, user.to_dict()) + '\n')
+                documents += 1
+                for children in user_pages:
+                    for child in children:
+                        output.write(dumps(child.reference.path, child.to_dict()) + '\n')
+                    documents += len(children)
+            output.flush()
+            os.fsync(output.fileno())
+            state = {'after': page[-1].id, 'offset': output.tell(), 'documents': documents}
+            write_checkpoint(checkpoint_path, state)
+            print("exported", documents, "documents", file=sys.stderr)
+    return documents
+
+
+def prepare(path, data):
+    """Adjust a document for import and return it, raising ValueError for paths outside twitter_user."""
+    parts = path.split('/')
+    if len(parts) == 2 and parts[0] == USERS:
+        # The timeline is not imported, so have it rebuilt on the next visit
+        data.pop('timeline_ready', None)
+        return data
+    if len(parts) == 4 and parts[0] == USERS and parts[2] == 'tweets':
+        if tweet_search.TERMS_FIELD not in data:
+            data[tweet_search.TERMS_FIELD] = tweet_search.terms(data.get('tweetText'))
+        return data
+    if len(parts) == 4 and parts[0] == USERS and parts[2] in ('followers', 'followings'):
+        return data
+    raise ValueError("Not a user, tweet or follow edge path: " + path)
+
+
+def import_(db, input_path, checkpoint_path=None, max_ops=MAX_OPS_PER_SECOND, flush_every=FLUSH_EVERY):
+    """Write every document in input_path and return (documents written, paths that failed)."""
+    state = read_checkpoint(checkpoint_path)
+    documents = state.get('documents', 0)
+    failed = []
+
+    def on_error(failure, writer):
+        if failure.attempts < MAX_ATTEMPTS:
+            return True
+        failed.append(failure.operation.reference.path)
+        return False
+
+    # The writer ramps up to max_ops writes a second and holds at most flush_every in memory
+    writer = db.bulk_writer(options=BulkWriterOptions(initial_ops_per_second=min(max_ops, MAX_OPS_PER_SECOND),
+                                                      max_ops_per_second=max_ops))
+    writer.on_write_error(on_error)
+    with open(input_path, 'rb') as source:
+        source.seek(state.get('offset', 0))
+        queued = 0
+        for line in iter(source.readline, b''):
+            if not line.strip():
+                continue
+            path, data = loads(line)
+            writer.set(db.document(path), prepare(path, data))
+            queued += 1
+            if queued == flush_every:
+                writer.flush()
+                documents += queued
+                queued = 0
+                write_checkpoint(checkpoint_path, {'offset': source.tell(), 'documents': documents})
+                print("imported", documents, "documents", file=sys.stderr)
+        writer.close()
+        documents += queued
+        write_checkpoint(checkpoint_path, {'offset': source.tell(), 'documents': documents})
+    return documents - len(failed), failed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--project", help="Google Cloud project, if not the default one")
+    parser.add_argument("--checkpoint", help="file that records progress so a run can be resumed")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="write users, tweets and follows to an NDJSON file")
+    export_parser.add_argument("output")
+    export_parser.add_argument("--workers", type=int, default=EXPORT_WORKERS, help="users whose tweets are read at once")
+
+    import_parser = commands.add_parser("import", help="write users, tweets and follows from an NDJSON file")
+    import_parser.add_argument("input")
+    import_parser.add_argument("--max-ops", type=int, default=MAX_OPS_PER_SECOND, help="maximum writes per second")
+    import_parser.add_argument("--flush-every", type=int, default=FLUSH_EVERY, help="writes between checkpoints")
+    return parser.parse_args(argv)
+
+
+def cli(argv=None):
+    args = parse_args(argv)
+    db = backends.firestore_client(args.project)
+    if args.command == "export":
+        documents = export(db, args.output, args.checkpoint, args.workers)
+        print("exported", documents, "documents")
+        return 0
+    documents, failed = import_(db, args.input, args.checkpoint, args.max_ops, args.flush_every)
+    print("imported", documents, "documents")
+    for path in failed:
+        print("FAILED", path)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
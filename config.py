@@ -0,0 +1,44 @@
+import os
+
+try:
+    import local_constants
+except ImportError:
+    local_constants = None
+
+
+class Settings:
+    """Deployment settings for one app instance."""
+
+    def __init__(self, project=None, bucket=None, firestore_project=None, cache_url=None, templates_dir="templates", static_dir="static",
+                 max_in_flight=None, admission_wait=0.5, rate_limit=2.0, rate_burst=20):
+        # None lets the Google clients pick the project up from the environment
+        self.project = project
+        self.firestore_project = firestore_project or project
+        self.bucket = bucket
+        # e.g. redis://cache:6379/0 to share cached reads between workers
+        self.cache_url = cache_url
+        self.templates_dir = templates_dir
+        self.static_dir = static_dir
+        # Data access calls a worker runs at once (default: its pool size), and how
+        # long a call may wait for room before the request is shed
+        self.max_in_flight = max_in_flight
+        self.admission_wait = admission_wait
+        # Per user requests a second, and burst, on each expensive page; 0 turns it off
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+
+
+def from_env(environ=os.environ):
+    """Read settings from TWITTER_* variables, falling back to local_constants when it exists."""
+    return Settings(
+        project=environ.get("TWITTER_PROJECT") or getattr(local_constants, "PROJECT_NAME", None),
+        bucket=environ.get("TWITTER_BUCKET") or getattr(local_constants, "PROJECT_STORAGE_BUCKET", None),
+        firestore_project=environ.get("TWITTER_FIRESTORE_PROJECT"),
+        cache_url=environ.get("TWITTER_CACHE_URL"),
+        templates_dir=environ.get("TWITTER_TEMPLATES_DIR", "templates"),
+        static_dir=environ.get("TWITTER_STATIC_DIR", "static"),
+        max_in_flight=int(environ["TWITTER_MAX_IN_FLIGHT"]) if environ.get("TWITTER_MAX_IN_FLIGHT") else None,
+        admission_wait=float(environ.get("TWITTER_ADMISSION_WAIT", "0.5")),
+        rate_limit=float(environ.get("TWITTER_RATE_LIMIT", "2")),
+        rate_burst=int(environ.get("TWITTER_RATE_BURST", "20")),
+    )
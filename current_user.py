@@ -0,0 +1,92 @@
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+import follow_graph
+import versions
+from shared_cache import Cache
+
+# Seconds a user document is reused before it is read again
+USER_TTL = 60
+
+# Seconds a token uid's document ID is remembered; it never changes once found
+SESSION_TTL = 60 * 60
+
+# The document ID of each signed-in token uid, and any user document by its ID.
+# Documents are cached only by ID, so invalidating a document ID reaches every
+# session, including older accounts whose ID is not their uid.
+session_cache = Cache('session', SESSION_TTL)
+user_cache = Cache('user', USER_TTL)
+
+
+class CurrentUser:
+    """The signed-in user: their verified token plus their twitter_user document."""
+
+    def __init__(self, token, user_id, data):
+        self.token = token
+        self.id = user_id
+        self.data = data
+
+    @property
+    def username(self):
+        return self.data.get('username')
+
+
+def username_from_token(user_token):
+    return user_token.get('email').split('@')[0]
+
+
+def load_user(db, user_token):
+    users_ref = db.collection('twitter_user')
+    uid = user_token['user_id']
+    snapshot = users_ref.document(uid).get()
+    data = snapshot.to_dict() if snapshot.exists else None
+    if data and data.get('username'):
+        return uid, follow_graph.migrate_legacy(db, uid, data)
+
+    username = username_from_token(user_token)
+    # Accounts created before documents were keyed by uid are found by username
+    for doc in users_ref.where(filter=FieldFilter('username', '==', username)).limit(1).get():
+        return doc.id, follow_graph.migrate_legacy(db, doc.id, doc.to_dict())
+
+    user_data = {
+        "username": username,
+        "email": user_token.get('email'),
+        "follower_count": 0,
+        "following_count": 0,
+        "profile_url": ""
+    }
+    users_ref.document(uid).set(user_data)
+    return uid, user_data
+
+
+def resolve(db, user_token):
+    """Map a verified token to the caller's user document, creating it on first sign in."""
+    uid = user_token['user_id']
+
+    def load():
+        user_id, data = load_user(db, user_token)
+        user_cache.set(user_id, data)
+        return user_id
+
+    user_id = session_cache.get_or_load(uid, load)
+    data = get_user(db, user_id)
+    if data is None:
+        # The document went away since its ID was cached
+        session_cache.invalidate(uid)
+        user_id = session_cache.get_or_load(uid, load)
+        data = get_user(db, user_id)
+    return CurrentUser(user_token, user_id, data)
+
+
+def get_user(db, user_id):
+    """Return the data of any user's document, or None if there is no such user."""
+    def load():
+        snapshot = db.collection('twitter_user').document(user_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+    return user_cache.get_or_load(user_id, load)
+
+
+def invalidate(*user_ids):
+    """Forget users by document ID after their documents changed, in every worker."""
+    user_cache.invalidate(*user_ids)
+    # Their profile pages, and the pages of theirs that show follows, changed too
+    versions.bump('profile', *user_ids)
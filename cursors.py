@@ -0,0 +1,36 @@
+import base64
+import json
+from datetime import datetime
+
+from google.cloud import firestore
+
+
+def encode(date, key):
+    """Build an opaque cursor from a tweet's date and its ID (or document path)."""
+    raw = json.dumps([date.isoformat(), key]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode(cursor):
+    """Return (date, key) for a cursor from encode, raising ValueError if it is malformed."""
+    try:
+        date, key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.fromisoformat(date), key
+    except (TypeError, ValueError, UnicodeError) as err:
+        raise ValueError("Invalid cursor") from err
+
+
+def newest_first(query, page_size, cursor=None, document=None):
+    """Order query by date then document, newest first, and start after cursor.
+
+    document turns the cursor's key back into a DocumentReference. Because
+    the query resumes from the cursor instead of skipping rows, every page
+    costs page_size reads however deep it is.
+    """
+    query = (query.order_by('date', direction=firestore.Query.DESCENDING)
+             .order_by('__name__', direction=firestore.Query.DESCENDING)
+             .limit(page_size))
+    if cursor:
+        date, key = decode(cursor)
+        query = query.start_after({'date': date, '__name__': document(key)})
+    return query
@@ -0,0 +1,28 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# The Firestore and Storage clients are synchronous, so every call made from an
+# async route is handed to this pool instead of blocking the event loop.
+# The pool size bounds how many RPCs a single worker has in flight.
+MAX_WORKERS = int(os.environ.get("DATA_ACCESS_WORKERS", "32"))
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="data-access")
+
+async def run(func, *args, **kwargs):
+    """Run a blocking Firestore/Storage call on the data access pool.
+
+    Requests are admitted once when they arrive (see main.Admission), so a
+    call here is never turned away halfway through a request.
+    """
+    loop = asyncio.get_running_loop()
+    # Carry the request's context over so its RPCs are attributed to it
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+async def gather(*calls):
+    """Run several independent (func, *args) calls concurrently and return their results in order."""
+    return await asyncio.gather(*[run(*call) for call in calls])
@@ -0,0 +1,146 @@
+import heapq
+import random
+import re
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+import cursors
+import tweet_search
+from shared_cache import Cache
+
+# Tweets per page of the explore feed
+PAGE_SIZE = 20
+
+# Trending counts the tweets of the last WINDOW in hourly buckets. Each
+# bucket is split over SHARDS documents that writers pick at random, so no
+# one document takes every tweet's write. A Firestore TTL policy on the
+# 'trending_buckets' collection's 'expire_at' field deletes old buckets.
+BUCKET_SIZE = timedelta(hours=1)
+WINDOW = timedelta(hours=24)
+SHARDS = 8
+
+# Trending shows the TOP_K most counted terms, recomputed from the buckets
+# at most every REFRESH_INTERVAL and stored in one document
+TOP_K = 10
+REFRESH_INTERVAL = timedelta(minutes=5)
+
+# Words too common or too short to be worth trending
+STOP_WORDS = frozenset("""
+    the and for are but not you your all any can had has have her his how its our out she was
+    were what when who why with this that from they them then than there their will would
+    just about into over also been more some very
+""".split())
+MIN_WORD_LENGTH = 3
+
+_HASHTAG = re.compile(r"#\w+")
+
+# The first explore page and the trending list are the same for every viewer
+recent_cache = Cache('explore', 15)
+trending_cache = Cache('trending', 60)
+
+
+def trending_terms(text):
+    """Return the hashtags and words of a tweet that count towards trending, once each."""
+    counted = set(tag.lower() for tag in _HASHTAG.findall(text or ''))
+    # A hashtag's word is counted as the hashtag only
+    counted.update(word for word in tweet_search.words(_HASHTAG.sub(' ', text or ''))
+                   if len(word) >= MIN_WORD_LENGTH and word not in STOP_WORDS and not word.isdigit())
+    return counted
+
+
+def _utc(date):
+    # Firestore returns aware datetimes; the app writes naive UTC ones
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def bucket_start(date):
+    return _utc(date).replace(minute=0, second=0, microsecond=0)
+
+
+def buckets_ref(db):
+    return db.collection('trending_buckets')
+
+
+def count_terms(db, date, amounts):
+    """Add {term: amount} to the counters of the hour date falls in."""
+    start = bucket_start(date)
+    if not amounts or start + WINDOW <= datetime.utcnow():
+        # Nothing to count, or the tweet's hour has already left the window
+        return
+    shard = random.randrange(SHARDS)
+    buckets_ref(db).document('{:%Y%m%d%H}-{}'.format(start, shard)).set({
+        'start': start,
+        'expire_at': start + WINDOW + BUCKET_SIZE,
+        'counts': {term: firestore.Increment(amount) for term, amount in amounts.items()},
+    }, merge=True)
+
+
+def count_tweet(db, text, date, amount=1):
+    """Add a posted (amount=1) or deleted (amount=-1) tweet to its hour's counters."""
+    count_terms(db, date, {term: amount for term in trending_terms(text)})
+
+
+def recount_tweet(db, old_text, new_text, date):
+    """Move an edited tweet's counts from the terms it lost to the terms it gained."""
+    old_terms, new_terms = trending_terms(old_text), trending_terms(new_text)
+    amounts = {term: -1 for term in old_terms - new_terms}
+    amounts.update({term: 1 for term in new_terms - old_terms})
+    count_terms(db, date, amounts)
+
+
+def compute_top(db):
+    """Sum the buckets in the window and store the top terms; reads WINDOW / BUCKET_SIZE * SHARDS documents at most."""
+    now = datetime.utcnow()
+    totals = Counter()
+    buckets = buckets_ref(db).where(filter=FieldFilter('start', '>', bucket_start(now - WINDOW))).stream()
+    for bucket in buckets:
+        totals.update(bucket.to_dict().get('counts', {}))
+    top = heapq.nlargest(TOP_K, ((count, term) for term, count in totals.items() if count > 0))
+    data = {'terms': [{'term': term, 'count': count} for count, term in top], 'computed_at': now}
+    db.collection('trending').document('top').set(data)
+    return data
+
+
+def trending(db):
+    """Return the trending terms as [{'term', 'count'}], usually from cache and otherwise one read."""
+    def load():
+        snapshot = db.collection('trending').document('top').get()
+        data = snapshot.to_dict() if snapshot.exists else None
+        if data is None or _utc(data['computed_at']) + REFRESH_INTERVAL <= datetime.utcnow():
+            data = compute_top(db)
+        return data['terms']
+    return trending_cache.get_or_load('top', load)
+
+
+def recent_tweets(db, cursor=None, page_size=PAGE_SIZE):
+    """Return (tweets, next_cursor) for everyone's tweets, newest first.
+
+    Needs the collection group index on 'tweets' ordered by date and
+    __name__ descending; cursors hold full paths like search cursors.
+    """
+    query = cursors.newest_first(db.collection_group('tweets'), page_size, cursor, db.document)
+    docs = list(query.stream())
+    next_cursor = None
+    if len(docs) == page_size:
+        last = docs[-1]
+        next_cursor = cursors.encode(last.get('date'), last.reference.path)
+
+    tweets = []
+    for doc in docs:
+        tweet = doc.to_dict()
+        tweet.pop(tweet_search.TERMS_FIELD, None)
+        tweet['tweetID'] = doc.id
+        tweet['userID'] = doc.reference.parent.parent.id
+        tweets.append(tweet)
+    return tweets, next_cursor
+
+
+def explore_page(db, cursor=None):
+    if cursor:
+        return recent_tweets(db, cursor)
+    return recent_cache.get_or_load('first', lambda: recent_tweets(db))
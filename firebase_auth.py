@@ -0,0 +1,148 @@
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from google.auth import exceptions, jwt
+
+log = logging.getLogger("twitter")
+
+# Public keys used to sign Firebase ID tokens
+FIREBASE_CERTS_URL = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+
+# Used when the certs response has no usable Cache-Control header
+DEFAULT_CERTS_MAX_AGE = 3600
+
+# Refresh the keys this many seconds before Google says they expire
+REFRESH_MARGIN = 300
+
+# A token signed with an unknown key refetches the keys at most this often,
+# so forged key ids can't turn every request into a call to Google
+FORCED_REFRESH_INTERVAL = 60
+
+# Number of already verified tokens to remember
+TOKEN_CACHE_SIZE = 4096
+
+_MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+class TokenVerifier:
+    """Verifies Firebase ID tokens against cached signing keys.
+
+    The keys are kept fresh by a background thread that follows the
+    Cache-Control max-age of Google's certs endpoint, and tokens that were
+    already verified are served from a bounded LRU until they expire.
+    """
+
+    def __init__(self, request, certs_url=FIREBASE_CERTS_URL, audience=None, cache_size=TOKEN_CACHE_SIZE):
+        self.request = request
+        self.certs_url = certs_url
+        self.audience = audience
+        self.cache_size = cache_size
+        self.certs = None
+        self.certs_expiry = 0
+        self.tokens = OrderedDict()
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.last_forced_refresh = None
+        self.refresher = None
+        self.stopping = threading.Event()
+
+    def fetch_certs(self):
+        response = self.request(self.certs_url, method="GET")
+        if response.status != 200:
+            raise exceptions.TransportError("Could not fetch certificates at {}".format(self.certs_url))
+        match = _MAX_AGE.search(response.headers.get("cache-control", ""))
+        max_age = int(match.group(1)) if match else DEFAULT_CERTS_MAX_AGE
+        return json.loads(response.data.decode("utf-8")), max_age
+
+    def refresh_certs(self):
+        with self.refresh_lock:
+            certs, max_age = self.fetch_certs()
+            self.certs = certs
+            self.certs_expiry = time.time() + max_age
+        return max_age
+
+    def force_refresh(self):
+        """Refetch the keys out of schedule, unless that was done less than FORCED_REFRESH_INTERVAL ago."""
+        with self.lock:
+            now = time.monotonic()
+            if self.last_forced_refresh is not None and now - self.last_forced_refresh < FORCED_REFRESH_INTERVAL:
+                return False
+            self.last_forced_refresh = now
+        self.refresh_certs()
+        return True
+
+    def get_certs(self):
+        # Only fetch inline when the background refresh has not run yet or fell behind
+        if self.certs is None or time.time() >= self.certs_expiry:
+            self.refresh_certs()
+        return self.certs
+
+    def start(self):
+        """Start refreshing the signing keys in the background."""
+        if self.refresher is None:
+            self.stopping.clear()
+            self.refresher = threading.Thread(target=self._refresh_loop, name="firebase-certs", daemon=True)
+            self.refresher.start()
+
+    def stop(self):
+        if self.refresher is not None:
+            self.stopping.set()
+            self.refresher.join()
+            self.refresher = None
+
+    def warm(self):
+        """Fetch the signing keys now so the first request does not have to."""
+        try:
+            self.get_certs()
+        except (exceptions.TransportError, ValueError) as err:
+            log.warning("Could not fetch Firebase certs: %s", err)
+
+    def _refresh_loop(self):
+        # Keys fetched by warm() are not fetched again until they near expiry
+        delay = max(self.certs_expiry - time.time() - REFRESH_MARGIN, 0)
+        while not self.stopping.wait(delay):
+            try:
+                max_age = self.refresh_certs()
+                delay = max(max_age - REFRESH_MARGIN, 60)
+            except (exceptions.TransportError, ValueError) as err:
+                log.warning("Could not refresh Firebase certs: %s", err)
+                delay = 60
+
+    def cached(self, id_token):
+        with self.lock:
+            claims = self.tokens.get(id_token)
+            if claims is None:
+                return None
+            if claims["exp"] <= time.time():
+                del self.tokens[id_token]
+                return None
+            self.tokens.move_to_end(id_token)
+            return claims
+
+    def remember(self, id_token, claims):
+        with self.lock:
+            self.tokens[id_token] = claims
+            self.tokens.move_to_end(id_token)
+            while len(self.tokens) > self.cache_size:
+                self.tokens.popitem(last=False)
+
+    def decode(self, id_token):
+        try:
+            return jwt.decode(id_token, certs=self.get_certs(), audience=self.audience)
+        except ValueError as err:
+            # The token may be signed with a key that was rotated in after our last refresh
+            if "Certificate for key id" not in str(err) or not self.force_refresh():
+                raise
+            return jwt.decode(id_token, certs=self.certs, audience=self.audience)
+
+    def verify(self, id_token):
+        """Return the claims of a valid token, raising ValueError otherwise."""
+        claims = self.cached(id_token)
+        if claims is None:
+            claims = self.decode(id_token)
+            self.remember(id_token, claims)
+        return claims
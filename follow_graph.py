@@ -0,0 +1,141 @@
+from datetime import datetime
+
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.cloud import firestore
+
+# The follow graph is stored as edge documents rather than arrays on the user:
+#   twitter_user/{user}/followers/{follower}    one per follower
+#   twitter_user/{user}/followings/{following} one per followed user
+# with follower_count / following_count kept on the user document.
+
+# Firestore allows at most 500 writes in one batch
+BATCH_SIZE = 500
+
+
+def users_ref(db):
+    return db.collection('twitter_user')
+
+
+def followers_ref(db, user_id):
+    return users_ref(db).document(user_id).collection('followers')
+
+
+def followings_ref(db, user_id):
+    return users_ref(db).document(user_id).collection('followings')
+
+
+def follower_count(user_data):
+    return user_data.get('follower_count', len(user_data.get('followers', [])))
+
+
+def following_count(user_data):
+    return user_data.get('following_count', len(user_data.get('followings', [])))
+
+
+def is_legacy(user_data):
+    return isinstance(user_data.get('followers'), list) or isinstance(user_data.get('followings'), list)
+
+
+def migrate_legacy(db, user_id, user_data):
+    """Move a user's followers/followings arrays into edge documents.
+
+    Both directions of every edge are written, so the other side of each
+    relation is correct even before that user is migrated. Returns the user
+    data without the arrays.
+    """
+    if not is_legacy(user_data):
+        return user_data
+    followers = user_data.get('followers') or []
+    followings = user_data.get('followings') or []
+    now = datetime.utcnow()
+    writes = []
+    for follower_id in followers:
+        writes.append((followers_ref(db, user_id).document(follower_id), {'date': now}))
+        writes.append((followings_ref(db, follower_id).document(user_id), {'date': now}))
+    for following_id in followings:
+        writes.append((followings_ref(db, user_id).document(following_id), {'date': now}))
+        writes.append((followers_ref(db, following_id).document(user_id), {'date': now}))
+
+    for start in range(0, len(writes), BATCH_SIZE):
+        batch = db.batch()
+        for ref, data in writes[start:start + BATCH_SIZE]:
+            batch.set(ref, data)
+        batch.commit()
+
+    counts = {'follower_count': len(followers), 'following_count': len(followings)}
+    users_ref(db).document(user_id).update(dict(counts, followers=firestore.DELETE_FIELD, followings=firestore.DELETE_FIELD))
+    migrated = {key: value for key, value in user_data.items() if key not in ('followers', 'followings')}
+    migrated.update(counts)
+    return migrated
+
+
+def follow(db, follower_id, following_id):
+    """Create the edge in both directions and bump both counters in one batched write.
+
+    Returns False if the follower was already following.
+    """
+    now = datetime.utcnow()
+    batch = db.batch()
+    # create() fails the whole batch if the edge exists, so counters can't drift
+    batch.create(followings_ref(db, follower_id).document(following_id), {'date': now})
+    batch.create(followers_ref(db, following_id).document(follower_id), {'date': now})
+    batch.update(users_ref(db).document(follower_id), {'following_count': firestore.Increment(1)})
+    batch.update(users_ref(db).document(following_id), {'follower_count': firestore.Increment(1)})
+    try:
+        batch.commit()
+    except AlreadyExists:
+        return False
+    return True
+
+
+def unfollow(db, follower_id, following_id):
+    """Delete the edge in both directions and decrement both counters in one batched write.
+
+    Returns False if the follower was not following.
+    """
+    exists = db.write_option(exists=True)
+    batch = db.batch()
+    batch.delete(followings_ref(db, follower_id).document(following_id), option=exists)
+    batch.delete(followers_ref(db, following_id).document(follower_id), option=exists)
+    batch.update(users_ref(db).document(follower_id), {'following_count': firestore.Increment(-1)})
+    batch.update(users_ref(db).document(following_id), {'follower_count': firestore.Increment(-1)})
+    try:
+        batch.commit()
+    except NotFound:
+        return False
+    return True
+
+
+def is_following(db, follower_id, following_id):
+    return followings_ref(db, follower_id).document(following_id).get().exists
+
+
+def edge_ids(query):
+    return [doc.id for doc in query.select(['__name__']).stream()]
+
+
+def follower_ids(db, user_id):
+    return edge_ids(followers_ref(db, user_id))
+
+
+def following_ids(db, user_id):
+    return edge_ids(followings_ref(db, user_id))
+
+
+def following_subset(db, user_id, candidate_ids):
+    """Return the candidates that user_id follows, using one batched read."""
+    refs = [followings_ref(db, user_id).document(candidate_id) for candidate_id in candidate_ids]
+    if not refs:
+        return []
+    return [snapshot.id for snapshot in db.get_all(refs, field_paths=['date']) if snapshot.exists]
+
+
+def list_page(ref, limit, cursor=None):
+    """Return one page of edge IDs in ID order and the cursor for the next page, or None."""
+    query = ref.order_by('__name__').limit(limit + 1)
+    if cursor:
+        query = query.start_after({'__name__': cursor})
+    ids = edge_ids(query)
+    if len(ids) > limit:
+        return ids[:limit], ids[limit - 1]
+    return ids, None
@@ -0,0 +1,100 @@
+import hashlib
+import logging
+import mimetypes
+import os
+import tempfile
+import time
+
+from google.api_core.exceptions import PreconditionFailed
+
+from ttl_cache import TTLCache
+
+log = logging.getLogger("twitter")
+
+# Size of each read from the multipart body
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Spooled uploads larger than this are moved from memory to a temp file
+SPOOL_MAX_SIZE = 4 * 1024 * 1024
+
+# Files above this size use a resumable upload sent in UPLOAD_CHUNK_SIZE pieces
+RESUMABLE_THRESHOLD = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 8 * 256 * 1024  # must be a multiple of 256 KiB
+
+# Images are stored under their content hash, so identical files share one object
+IMAGE_PREFIX = 'images/'
+
+# The tweet or profile already points at the image when it is uploaded, so
+# failed uploads are retried, waiting RETRY_DELAY seconds and doubling it each time
+UPLOAD_ATTEMPTS = 6
+RETRY_DELAY = 1.0
+
+# Paths this process has already uploaded or found in the bucket
+known_paths = TTLCache(ttl=24 * 60 * 60, maxsize=100000)
+
+
+class PendingUpload:
+    """An uploaded image spooled locally, waiting to be written to the bucket."""
+
+    def __init__(self, path, file, size, content_type):
+        self.path = path
+        self.file = file
+        self.size = size
+        self.content_type = content_type
+
+
+def image_path(digest, filename):
+    extension = os.path.splitext(filename or '')[1].lower()
+    return IMAGE_PREFIX + digest + extension
+
+
+def spool(upload):
+    """Copy an UploadFile into a private spool in chunks, hashing it on the way."""
+    digest = hashlib.sha256()
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    size = 0
+    upload.file.seek(0)
+    while True:
+        chunk = upload.file.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        spooled.write(chunk)
+        size += len(chunk)
+    spooled.seek(0)
+    content_type = upload.content_type or mimetypes.guess_type(upload.filename or '')[0]
+    return PendingUpload(image_path(digest.hexdigest(), upload.filename), spooled, size, content_type)
+
+
+def upload_once(bucket, pending):
+    blob = bucket.blob(pending.path)
+    if pending.size > RESUMABLE_THRESHOLD:
+        blob.chunk_size = UPLOAD_CHUNK_SIZE
+    pending.file.seek(0)
+    try:
+        # if_generation_match=0 only creates the object, so a duplicate costs no extra lookup
+        blob.upload_from_file(pending.file, size=pending.size, content_type=pending.content_type,
+                              predefined_acl='publicRead', if_generation_match=0)
+    except PreconditionFailed:
+        pass
+
+
+def upload(bucket, pending, attempts=UPLOAD_ATTEMPTS, delay=RETRY_DELAY):
+    """Write a spooled image to the bucket unless an identical one is already there, retrying failures."""
+    try:
+        if known_paths.get(pending.path):
+            return
+        for attempt in range(1, attempts + 1):
+            try:
+                upload_once(bucket, pending)
+                break
+            except Exception as err:
+                if attempt == attempts:
+                    log.error("Image upload failed for %s after %d attempts: %s", pending.path, attempts, err)
+                    return
+                log.warning("Image upload failed for %s, retrying: %s", pending.path, err)
+                time.sleep(delay)
+                delay *= 2
+        known_paths.set(pending.path, True)
+    finally:
+        pending.file.close()
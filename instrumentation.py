@@ -0,0 +1,214 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from starlette.routing import Match
+
+import backends
+from metrics import COUNT_BUCKETS, registry
+
+log = logging.getLogger("twitter")
+
+# Fraction of routine events that are logged; errors are always logged
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.01"))
+
+request_seconds = registry.histogram("http_request_duration_seconds", "Request latency", ("route", "method", "status"))
+request_rpcs = registry.histogram("http_request_rpcs", "Firestore and Storage RPCs per request", ("route",), COUNT_BUCKETS)
+request_documents = registry.histogram("http_request_documents_read", "Firestore documents read per request", ("route",), COUNT_BUCKETS)
+rpc_seconds = registry.histogram("rpc_duration_seconds", "Firestore and Storage RPC latency", ("route", "service", "method"))
+rpc_bytes = registry.counter("rpc_bytes_total", "Bytes received from Firestore and Storage", ("route", "service"))
+template_seconds = registry.histogram("template_render_seconds", "Jinja template render time", ("template",))
+
+
+class RequestStats:
+    """RPC totals for the request being served, shared with its worker threads."""
+
+    def __init__(self, route):
+        self.route = route
+        self.rpcs = 0
+        self.documents = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, documents, size):
+        with self.lock:
+            self.rpcs += 1
+            self.documents += documents
+            self.bytes += size
+
+
+current = contextvars.ContextVar("request_stats", default=None)
+
+
+def current_route():
+    stats = current.get()
+    return stats.route if stats else "background"
+
+
+def log_sampled(event, **fields):
+    """Log a routine event for a sample of calls, skipping the formatting otherwise."""
+    if LOG_SAMPLE_RATE and random.random() < LOG_SAMPLE_RATE:
+        fields.update(event=event, route=current_route())
+        log.info(json.dumps(fields, default=str))
+
+
+def record_rpc(service, method, seconds, documents=0, size=0):
+    route = current_route()
+    rpc_seconds.observe(seconds, route=route, service=service, method=method)
+    if size:
+        rpc_bytes.inc(size, route=route, service=service)
+    stats = current.get()
+    if stats is not None:
+        stats.add(documents, size)
+
+
+def _message_size(message):
+    pb = getattr(message, "_pb", None)
+    return pb.ByteSize() if pb is not None else 0
+
+
+class _TimedStream:
+    # Streaming RPCs are timed and counted until the caller has drained them
+
+    def __init__(self, stream, method, document_field):
+        self._stream = stream
+        self._method = method
+        self._document_field = document_field
+        self._started = time.perf_counter()
+        self._documents = 0
+        self._size = 0
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            response = next(self._stream)
+        except StopIteration:
+            self._finish()
+            raise
+        self._size += _message_size(response)
+        pb = getattr(response, "_pb", None)
+        if self._document_field and pb is not None and pb.HasField(self._document_field):
+            self._documents += 1
+        return response
+
+    def _finish(self):
+        if not self._done:
+            self._done = True
+            record_rpc("firestore", self._method, time.perf_counter() - self._started, self._documents, self._size)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+# GAPIC methods that stream responses, and the field that carries a document
+FIRESTORE_STREAMING = {"run_query": "document", "batch_get_documents": "found", "run_aggregation_query": None}
+FIRESTORE_UNARY = ("get_document", "list_documents", "commit", "begin_transaction", "rollback", "batch_write",
+                   "create_document", "update_document", "delete_document", "list_collection_ids", "partition_query")
+
+
+def _wrap_unary(function, method):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        response = function(*args, **kwargs)
+        documents = 1 if method == "get_document" else 0
+        record_rpc("firestore", method, time.perf_counter() - started, documents, _message_size(response))
+        return response
+    return wrapper
+
+
+def _wrap_streaming(function, method, document_field):
+    def wrapper(*args, **kwargs):
+        return _TimedStream(function(*args, **kwargs), method, document_field)
+    return wrapper
+
+
+def _memory_listener(name, amount):
+    service, method = name.split(".", 1)
+    if method == "docs_read":
+        stats = current.get()
+        if stats is not None:
+            with stats.lock:
+                stats.documents += amount
+    elif method == "bytes_uploaded":
+        rpc_bytes.inc(amount, route=current_route(), service=service)
+    elif method != "docs_written":
+        record_rpc(service, method, 0)
+
+
+def instrument_firestore(client):
+    """Count and time every RPC the Firestore client issues."""
+    if backends.use_memory():
+        import memory_backend
+        if _memory_listener not in memory_backend.listeners:
+            memory_backend.listeners.append(_memory_listener)
+        return client
+    api = client._firestore_api
+    for method in FIRESTORE_UNARY:
+        setattr(api, method, _wrap_unary(getattr(api, method), method))
+    for method, document_field in FIRESTORE_STREAMING.items():
+        setattr(api, method, _wrap_streaming(getattr(api, method), method, document_field))
+    return client
+
+
+def instrument_storage(client):
+    """Count and time every HTTP call the Storage client makes."""
+    if backends.use_memory():
+        # The memory backend reports Storage calls through the same listener as Firestore
+        return client
+    session = client._http
+    request = session.request
+
+    def timed_request(method, url, *args, **kwargs):
+        started = time.perf_counter()
+        response = request(method, url, *args, **kwargs)
+        size = int(response.headers.get("content-length") or 0)
+        record_rpc("storage", method.lower(), time.perf_counter() - started, 0, size)
+        return response
+
+    session.request = timed_request
+    return client
+
+
+def time_templates(template_response):
+    """Wrap Jinja2Templates.TemplateResponse so render time is recorded per template."""
+    def wrapper(name, *args, **kwargs):
+        started = time.perf_counter()
+        response = template_response(name, *args, **kwargs)
+        template_seconds.observe(time.perf_counter() - started, template=name)
+        return response
+    return wrapper
+
+
+def route_name(app, scope):
+    # Label by route template so IDs in the path do not explode the label set
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+async def track_request(app, request, call_next):
+    stats = RequestStats(route_name(app, request.scope))
+    token = current.set(stats)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        duration = time.perf_counter() - started
+        request_seconds.observe(duration, route=stats.route, method=request.method, status=status)
+        request_rpcs.observe(stats.rpcs, route=stats.route)
+        request_documents.observe(stats.documents, route=stats.route)
+        log_sampled("request", method=request.method, status=status, duration_ms=round(duration * 1000, 2),
+                    rpcs=stats.rpcs, documents=stats.documents, bytes=stats.bytes)
+        current.reset(token)
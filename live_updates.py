@@ -0,0 +1,168 @@
+import asyncio
+import json
+import threading
+from datetime import datetime
+
+import anyio
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+import instrumentation
+import timeline_store
+from metrics import registry
+
+# Diffs buffered per connection before it is told to reload instead
+QUEUE_SIZE = 100
+
+# Seconds between comment lines that keep idle connections open through proxies
+HEARTBEAT_INTERVAL = 15
+
+open_streams = registry.gauge("live_streams", "Open live timeline connections")
+open_listeners = registry.gauge("live_listeners", "Firestore snapshot listeners held for live timelines")
+
+
+class Subscriber:
+    """One open connection; diffs arrive from listener threads and are read on the event loop."""
+
+    def __init__(self, loop, maxsize=QUEUE_SIZE):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+        self.overflowed = False
+
+    def push(self, diffs):
+        self.loop.call_soon_threadsafe(self._put, diffs)
+
+    def _put(self, diffs):
+        try:
+            self.queue.put_nowait(diffs)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class ChangeFeed:
+    """Process-wide change feed for home timelines.
+
+    Each source - a user's materialized timeline, or a large author whose
+    tweets are merged on read - has at most one snapshot listener in the
+    process, shared by every connection that needs it. Listeners only match
+    documents written after they started, so subscribing reads nothing old.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.sources = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, user_id, subscriber):
+        """Attach subscriber to every source of user_id's timeline and return the source keys."""
+        keys = [('timeline', user_id)]
+        keys.extend(('author', author_id) for author_id in timeline_store.large_followed_authors(self.db, user_id))
+        for key in keys:
+            self._attach(key, subscriber)
+        return keys
+
+    def unsubscribe(self, keys, subscriber):
+        for key in keys:
+            watch = None
+            with self.lock:
+                source = self.sources.get(key)
+                if source is None:
+                    continue
+                source['subscribers'].discard(subscriber)
+                if not source['subscribers']:
+                    watch = self.sources.pop(key)['watch']
+                    open_listeners.set(len(self.sources))
+            if watch is not None:
+                watch.unsubscribe()
+
+    def stop(self):
+        with self.lock:
+            sources, self.sources = self.sources, {}
+            open_listeners.set(0)
+        for source in sources.values():
+            source['watch'].unsubscribe()
+
+    def _attach(self, key, subscriber):
+        with self.lock:
+            source = self.sources.get(key)
+            if source is not None:
+                source['subscribers'].add(subscriber)
+                return
+            source = self.sources[key] = {'subscribers': {subscriber}, 'watch': None}
+            open_listeners.set(len(self.sources))
+            # Start under the lock so a second subscriber never opens a duplicate listener
+            source['watch'] = self._query(key).on_snapshot(
+                lambda docs, changes, read_time: self._on_snapshot(key, changes))
+
+    def _query(self, key):
+        kind, owner = key
+        since = datetime.utcnow()
+        if kind == 'timeline':
+            # Entries are stamped with 'updated' whenever a tweet is pushed or edited
+            return timeline_store.timeline_ref(self.db, owner).where(filter=FieldFilter('updated', '>=', since))
+        return timeline_store.tweets_ref(self.db, owner).where(filter=FieldFilter('date', '>=', since))
+
+    def _on_snapshot(self, key, changes):
+        kind, owner = key
+        diffs = []
+        for change in changes:
+            doc = change.document
+            data = doc.to_dict() or {}
+            if change.type.name == 'REMOVED' or data.get('deleted'):
+                diffs.append({'op': 'remove', 'tweetID': doc.id})
+            elif kind == 'timeline':
+                # Edits reach timelines that never had the tweet as entries without a date; skip those
+                if 'date' in data:
+                    diffs.append({'op': 'upsert', 'tweet': data})
+            else:
+                diffs.append({'op': 'upsert', 'tweet': timeline_store.timeline_entry(owner, doc.id, data)})
+        if not diffs:
+            return
+        with self.lock:
+            source = self.sources.get(key)
+            subscribers = list(source['subscribers']) if source else []
+        for subscriber in subscribers:
+            subscriber.push(diffs)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def event(name, data):
+    """Format one Server-Sent Event."""
+    return "event: {}\ndata: {}\n\n".format(name, json.dumps(data, default=_json_default))
+
+
+async def stream(feed, request, user_id, run, prepare=None):
+    """Yield Server-Sent Events with the diffs for user_id's timeline until the client goes away.
+
+    run is used to call the blocking feed methods off the event loop, and
+    prepare, if given, is applied to each batch of diffs before it is sent.
+    """
+    subscriber = Subscriber(asyncio.get_running_loop())
+    keys = await run(feed.subscribe, user_id, subscriber)
+    open_streams.inc()
+    try:
+        yield "retry: 5000\n\n"
+        while not await request.is_disconnected():
+            try:
+                diffs = await asyncio.wait_for(subscriber.queue.get(), HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if prepare is not None:
+                diffs = prepare(diffs)
+            yield event("timeline", diffs)
+            if subscriber.overflowed:
+                # The client fell too far behind for diffs to be trusted
+                instrumentation.log_sampled("live_stream_overflow", user_id=user_id)
+                yield event("reset", {})
+                break
+    finally:
+        open_streams.inc(-1)
+        # The response cancels the stream when the client disconnects; the
+        # listeners must still be released
+        with anyio.CancelScope(shield=True):
+            await run(feed.unsubscribe, keys, subscriber)
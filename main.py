@@ -1,519 +1,700 @@
-from fastapi import FastAPI, Request, Query, Form, UploadFile, File, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, Response
+from fastapi import FastAPI, APIRouter, Request, Query, Form, UploadFile, File, HTTPException, Depends, BackgroundTasks
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Dict, Optional
 from datetime import datetime, timedelta
-import google.oauth2.id_token
-from google.auth.transport import requests
-from google.cloud import firestore, storage
 import starlette.status as status
 from google.cloud.firestore_v1.base_query import FieldFilter
-import local_constants
+from google.api_core.exceptions import FailedPrecondition, NotFound
+import timeline_store
+import data_access
+import current_user
+import image_uploads
+import follow_graph
+import tweet_search
+import cursors
+import live_updates
+import instrumentation
+import metrics
 import os
+import functools
+from contextlib import asynccontextmanager
+import config
+import resources
+import page_cache
+import versions
+import explore
+import admission
 
-# Create a FastAPI app instance
-app = FastAPI()
-firebase_request_adapter = requests.Request()
+router = APIRouter()
 
-# Initialize Firestore client with the correct project ID
-firestore_db = firestore.Client(project="twitter-52984")
-# firestore_db = firestore.Client(project="evproject-417219")
 
+def get_resources(request: Request):
+    # The clients of the app serving this request, opened by its lifespan
+    return request.app.state.resources
 
-app.mount('/static', StaticFiles(directory='static'), name='static')
-templates = Jinja2Templates(directory="templates") 
+
+class BindResources:
+    """ASGI middleware pointing the caches and admission control of each request at its own app's."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        clients = scope["app"].state.resources
+        token = clients.use()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            clients.reset(token)
+
+
+async def instrument_requests(request: Request, call_next):
+    # Latency, RPC count and documents read per route, exported on /metrics
+    return await instrumentation.track_request(request.app, request, call_next)
+
+
+class Admission:
+    """ASGI middleware admitting each request once, before any of its work, into the app's concurrency limit.
+
+    The slot is held until the response has been sent, but not for the
+    background tasks after it (image uploads, which retry on their own), nor
+    for the live update streams, which stay open as long as a page does.
+    """
+
+    EXEMPT_PATHS = ("/static/", "/metrics", "/timeline/stream")
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.EXEMPT_PATHS):
+            return await self.app(scope, receive, send)
+        limiter = scope["app"].state.resources.limiter
+        try:
+            await limiter.acquire()
+        except admission.Overloaded as err:
+            request = Request(scope, receive)
+            # The fallback page is kept per client, so identify it without the user lookup
+            user_token = await data_access.run(validateFirebaseToken, get_resources(request).token_verifier, request.cookies.get("token"))
+            request.state.client_key = client_key(request, user_token)
+            response = await shed_request(request, err)
+            return await response(scope, receive, send)
+
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                limiter.release()
+
+        async def send_and_release(message):
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                release()
+
+        try:
+            await self.app(scope, receive, send_and_release)
+        finally:
+            release()
+
+
+async def shed_request(request: Request, err: admission.Rejected):
+    # Rather than a bare error, show the client the page it last got for this URL
+    headers = {"Retry-After": str(err.retry_after)}
+    page = await data_access.run(page_cache.fallback, request)
+    admission.shed.inc(route=instrumentation.current_route(), reason=err.reason, response="stale" if page else "error")
+    if page is not None:
+        return HTMLResponse(page, headers=dict(headers, **{"Cache-Control": "no-store"}))
+    return JSONResponse({"detail": err.detail}, status_code=err.status_code, headers=headers)
+
+
+def create_app(settings=None):
+    """Build the app; its clients are opened at startup and closed at shutdown."""
+    settings = settings or config.from_env()
+
+    @asynccontextmanager
+    async def lifespan(app):
+        worker_resources = await data_access.run(resources.Resources(settings).open)
+        await data_access.run(worker_resources.warm)
+        app.state.resources = worker_resources
+        try:
+            yield
+        finally:
+            await data_access.run(worker_resources.close)
+
+    app = FastAPI(lifespan=lifespan)
+    app.mount('/static', StaticFiles(directory=settings.static_dir), name='static')
+    # Inside the instrumentation, so shed requests are measured too
+    app.add_middleware(Admission)
+    app.middleware("http")(instrument_requests)
+    # Outermost, so everything the request runs sees its app's resources
+    app.add_middleware(BindResources)
+    app.add_exception_handler(admission.Rejected, shed_request)
+    app.include_router(router)
+    return app
+
+
+@router.get("/metrics")
+def metrics_page():
+    return Response(metrics.registry.render(), media_type="text/plain; version=0.0.4")
 # Define a route for the root URL
 
-def validateFirebaseToken(id_token):
+def validateFirebaseToken(token_verifier, id_token):
     if not id_token:
         return None
 
     user_token = None
     try:
-        user_token=google.oauth2.id_token.verify_firebase_token(id_token,firebase_request_adapter)   
+        user_token=token_verifier.verify(id_token)
     except ValueError as err:
-        print(str(err))
+        instrumentation.log_sampled("invalid_token", error=str(err))
     return user_token
 
 
-def get_username_list():
-    usernames = []
-    # Assuming you have a collection named "users" and each document contains a field "username"
-    users_ref = firestore_db.collection('twitter_user')
-    docs = users_ref.stream()
+def get_username_list(username_dir):
+    # Served from memory; the directory follows 'twitter_user' with a snapshot listener
+    return username_dir.all()
 
-    for doc in docs:
-        data = doc.to_dict()
-        data['id'] = doc.id
-        usernames.append(data)        
-    return usernames
+# Number of tweets per page on /user_profile
+PROFILE_TWEETS_PAGE_SIZE = 10
 
-# Get user's tweets
-def get_user_tweets(user_id,username):
-    tweets_ref = firestore_db.collection("twitter_user").document(user_id).collection("tweets").where("username", "==", username).order_by("date", direction=firestore.Query.DESCENDING).limit(10)
-    tweets = [doc.to_dict() for doc in tweets_ref.stream()]
-    return tweets
+# Get a page of a user's tweets, returning (tweets, next_cursor)
+def get_user_tweets(db, user_id,username,cursor=None):
+    tweets_ref = db.collection("twitter_user").document(user_id).collection("tweets")
+    query = cursors.newest_first(tweets_ref.where("username", "==", username), PROFILE_TWEETS_PAGE_SIZE, cursor, tweets_ref.document)
+    tweets = []
+    for doc in query.stream():
+        tweet = doc.to_dict()
+        tweet['tweetID'] = doc.id
+        tweets.append(tweet)
+    next_cursor = None
+    if len(tweets) == PROFILE_TWEETS_PAGE_SIZE:
+        next_cursor = cursors.encode(tweets[-1]['date'], tweets[-1]['tweetID'])
+    return tweets, next_cursor
 
 
-def generate_timeline(user_id):
-    
-    user_tweets_ref = firestore_db.collection(f'twitter_user/{user_id}/tweets').order_by('date', direction=firestore.Query.DESCENDING).limit(20).stream()
-    user_tweets = []
-
-# Iterate over each tweet document
-    for doc in user_tweets_ref:
-        # Get the tweet data as a dictionary
-        tweet_data = doc.to_dict()
-        # Include the document ID in the tweet data
-        tweet_data['tweetID'] = doc.id
-        tweet_data['userID'] = user_id
-        # Append the tweet data to the list
-        user_tweets.append(tweet_data)
-
-    # print("user_tweets",user_tweets)
-    # Retrieve tweets from users the current user is following
-    following_ref = firestore_db.collection('twitter_user').document(user_id).get()
-    following = following_ref.to_dict().get('followings', [])
-    following_tweets = []
-    # print("following",following)
-    for following_id in following:
-        # print("following_id",following_id)
-        following_tweets_ref = firestore_db.collection(f'twitter_user/{following_id}/tweets').order_by('date', direction=firestore.Query.DESCENDING).limit(20).stream()
-            # Extend the following_tweets list with the tweets
-        for doc in following_tweets_ref:
-            # Get the tweet data as a dictionary
-            tweet_data = doc.to_dict()
-            # Include the document ID in the tweet data
-            tweet_data['tweetID'] = doc.id
-            tweet_data['userID'] = user_id
-            following_tweets.append(tweet_data)
-
-    # Combine and sort tweets
-    all_tweets = user_tweets + following_tweets
-    
-    all_tweets.sort(key=lambda x: x['date'], reverse=True)
+async def get_profile_tweets(db, user_id, username, cursor=None):
+    # Cached by the author's tweets stamp, so a write is seen on the next read
+    stamps = await data_access.run(versions.read, 'tweets:' + user_id)
+    return await page_cache.fragment(('user_tweets', user_id, username, cursor), stamps,
+                                     lambda: data_access.run(get_user_tweets, db, user_id, username, cursor), data_access.run)
 
-    # Display the last 20 tweets
-    timeline = all_tweets[:20]
-    # print("timeline",timeline)
-    return timeline
 
-def getTwitterUser(user_token):
+def tweets_changed(user_id):
+    versions.bump('tweets', user_id)
 
-    user = firestore_db.collection('twitter_user').document(user_token['user_id'])
 
-    if not user.get().exists:
-        user_data = {
-        "username":"",
-        "email":"",
-        "followers": [], 
-        "followings": [],
-        "profile_url":""
-        }
-        firestore_db.collection("twitter_user").document(user_token['user_id']).set(user_data)
-    return user
+def generate_timeline(db, user_id, user_data, cursor=None):
+    # Home timelines are materialized on write; see timeline_store
+    ready = user_data.get('timeline_ready')
+    page = timeline_store.read_timeline(db, user_id, user_data, cursor=cursor)
+    if not ready:
+        # The backfill set timeline_ready on the user document
+        current_user.invalidate(user_id)
+    return page
 
-def downloadBlob(image_data: list):
-    
-    images = []
-    for data in image_data: 
-        if 'image_url' in data:
-            image_url = data.get('image_url')
-        else:
-            image_url = data.get('profile_url')    
-        if image_url:
-            # Check if the image exists in Firestore Storage
-            storage_client = storage.Client(project=local_constants.PROJECT_NAME)
-            bucket = storage_client.bucket(local_constants.PROJECT_STORAGE_BUCKET)
-            blob = bucket.blob(image_url)
-            if blob.exists():
-                blob.make_public()
-                # Get the public URL of the object
-                image_url = blob.public_url                              
-                images.append({'image_url': image_url})
-    return images
-
-@app.get("/", response_class=HTMLResponse)
-async def root(request: Request):
-    id_token = request.cookies.get("token")
-    user_token = validateFirebaseToken(id_token)
-    if user_token:
-        tweetUser = getTwitterUser(user_token)
-        timeline = None
-        username_list = get_username_list()
-        # print("Usernames:", tweetUser)
-        username = user_token.get('email').split('@')[0]
-        # print("username*********",username)
-        # Check if the email already exists in the 'twitter_user' collection
-        user_ref = firestore_db.collection('twitter_user').where('username', '==', username).limit(1).get()
-        if not user_ref:
-            user_data = {
-                "username":username,
-                "email":user_token.get('email'),
-                "followers": [], 
-                "followings": [],
-                "profile_url":""
-            }
-            firestore_db.collection("twitter_user").document(user_token['user_id']).set(user_data)
-        else:
-            for data in user_ref:
-                user_doc_id = data.id
-                timeline = generate_timeline(user_doc_id)
-                
-                image_urls = downloadBlob(timeline)
-
-                if len(timeline) > 0 and len(image_urls) > 0:
-                    for tweet, image_url in zip(timeline, image_urls):
-                        # tweet['tweet_img'] = image_url
-                        tweet['image_url'] = image_url['image_url']
-                    
-                # print("timeline",timeline)
-        return templates.TemplateResponse("home.html", {"request": request, "user_token":user_token,"username_list":username_list,"timeline":timeline})
-    else:
-        return templates.TemplateResponse("login.html", {"request": request,"user_token": None})
 
-def addDirectory(directory_name):
-    
-    storage_client = storage.Client(project=local_constants.PROJECT_NAME)
-    bucket = storage_client.bucket(local_constants.PROJECT_STORAGE_BUCKET)
-    blob = bucket.blob(directory_name)
-    blob.upload_from_string('',content_type="application/x-www-form-urlencoded;charset=UTF-8")
+def attach_image_urls(media, tweets):
+    image_urls = media.tweet_image_urls(tweets)
+    for tweet in tweets:
+        if tweet['tweetID'] in image_urls:
+            tweet['image_url'] = image_urls[tweet['tweetID']]
+    return tweets
 
 
-def addFile(file, user_doc_id,tweet_id):
-    # Define the directory path
-    if tweet_id is None:
-        dir_name = 'profileImages/' + user_doc_id + '/'
-    else:
-        dir_name = 'tweetImages/' + user_doc_id + '/' + tweet_id + '/'
-       
-    if dir_name =='' or dir_name[-1] != '/':
-        print("dir_name",dir_name)
-        return RedirectResponse('/')
+def wants_json(request):
+    # The home page posts with fetch and applies the change from the live stream;
+    # plain form posts still get redirected back to a freshly rendered page
+    return "application/json" in request.headers.get("accept", "")
 
-    # Initialize the storage client
-    storage_client = storage.Client(project=local_constants.PROJECT_NAME)
 
-    # Get the bucket
-    bucket = storage_client.bucket(local_constants.PROJECT_STORAGE_BUCKET)
+def write_response(request, payload):
+    if wants_json(request):
+        return payload
+    return RedirectResponse("/",status_code=status.HTTP_302_FOUND)
 
-    # Create the directory if it doesn't exist
-    addDirectory(dir_name)
 
-    # Save the image file to the directory
-    image_path = os.path.join(dir_name, file.filename)
+def page_versions(clients):
+    # What every page depends on besides its own data: the username list, templates and image URLs
+    return (clients.username_dir.version, clients.templates_version, clients.media.epoch())
 
-    # Check if the file already exists
-    if blob_exists(bucket, image_path):
-        # If it exists, delete the existing file
-        delete_blob(bucket, image_path)
 
-    blob = bucket.blob(image_path)
-    blob.upload_from_file(file.file)
+async def home_timeline(db, user, cursor, large_authors, stamps):
+    # The timeline is cached by the timeline and large author stamps; stamps[1] is the profile stamp
+    return await page_cache.fragment(('timeline', user.id, cursor, large_authors), stamps[:1] + stamps[2:],
+                                     lambda: data_access.run(generate_timeline, db, user.id, user.data, cursor), data_access.run)
 
-    # Return the path to the saved image
-    return image_path
 
-def blob_exists(bucket, blob_name):
-    """Check if a blob exists in a bucket."""
-    return storage.Blob(bucket=bucket, name=blob_name).exists()
+def home_stamps(db, user_id):
+    # The home page also shows the recent tweets of followed large authors, merged on read
+    large_authors = sorted(timeline_store.large_followed_authors(db, user_id))
+    keys = ['timeline:' + user_id, 'profile:' + user_id] + ['tweets:' + author_id for author_id in large_authors]
+    return large_authors, versions.read(*keys)
 
-def delete_blob(bucket, blob_name):
-    """Delete a blob in a bucket."""
-    bucket.blob(blob_name).delete()
+async def get_user_token(request: Request, clients: resources.Resources = Depends(get_resources)):
+    # Verified once per request, before the user document is looked up
+    return await data_access.run(validateFirebaseToken, clients.token_verifier, request.cookies.get("token"))
 
-@app.post("/tweets")
-async def create_tweet(request: Request):
-    id_token = request.cookies.get("token")
-    user_token = validateFirebaseToken(id_token)
+async def get_current_user(user_token: Optional[dict] = Depends(get_user_token), clients: resources.Resources = Depends(get_resources)):
+    # Resolved once per request; the user document itself is cached by uid in current_user
     if not user_token:
+        return None
+    return await data_access.run(current_user.resolve, clients.firestore, user_token)
+
+def client_key(request, user_token):
+    # Signed-in users by uid, everyone else by address
+    if user_token:
+        return user_token['user_id']
+    return request.client.host if request.client else None
+
+def rate_limited(name):
+    """Dependency that holds each signed-in user, or else each client address, to the per-route rate limit.
+
+    It runs before the route's other dependencies, so a limited client costs no user lookup.
+    """
+    async def check(request: Request, user_token: Optional[dict] = Depends(get_user_token),
+                    clients: resources.Resources = Depends(get_resources)):
+        request.state.client_key = client_key(request, user_token)
+        clients.rate_limiter.check(name, request.state.client_key)
+    return Depends(check)
+
+
+@router.get("/", response_class=HTMLResponse, dependencies=[rate_limited("home")])
+async def root(request: Request, cursor: Optional[str] = None, user: current_user.CurrentUser = Depends(get_current_user), clients: resources.Resources = Depends(get_resources)):
+    if user:
+        async def render():
+            user_token = user.token
+            try:
+                timeline, next_cursor = await home_timeline(clients.firestore, user, cursor, large_authors, stamps)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            username_list = get_username_list(clients.username_dir)
+
+            attach_image_urls(clients.media, timeline)
+
+            # print("timeline",timeline)
+            return clients.templates.TemplateResponse("home.html", {"request": request, "user_token":user_token,"username_list":username_list,"timeline":timeline,"next_cursor":next_cursor})
+
+        # Revalidation and cached pages cost a few cache reads, not a timeline read
+        large_authors, stamps = await data_access.run(home_stamps, clients.firestore, user.id)
+        key = ('home', user.id, cursor, large_authors) + page_versions(clients)
+        return await page_cache.respond(request, key, stamps, render, data_access.run)
+    else:
+        return clients.templates.TemplateResponse("login.html", {"request": request,"user_token": None})
+
+def addFile(media, file, background_tasks):
+    # Spool and hash the image now, upload it after the response has been sent;
+    # the upload runs outside the request's admission slot, see Admission
+    pending = image_uploads.spool(file)
+    background_tasks.add_task(image_uploads.upload, media.bucket, pending)
+
+    # Return the path the image will be saved under
+    return pending.path
+
+def save_tweet(db, user_doc_id, user_data, tweet_data):
+    tweets_ref = db.collection('twitter_user').document(user_doc_id).collection('tweets')
+    # The document ID is allocated locally so the tweet is written once, image_url included
+    tweet_ref = tweets_ref.document()
+    tweet_id = tweet_ref.id
+    tweet_ref.set(tweet_data)
+    timeline_store.push_tweet(db, user_doc_id, user_data, tweet_id, tweet_data)
+    explore.count_tweet(db, tweet_data['tweetText'], tweet_data['date'])
+    return tweet_id
+
+@router.post("/tweets")
+async def create_tweet(request: Request, background_tasks: BackgroundTasks, user: current_user.CurrentUser = Depends(get_current_user), clients: resources.Resources = Depends(get_resources)):
+    if not user:
         message = "To add tweets, please log in or sign up first."
-        return templates.TemplateResponse("home.html", {"request": request, "user_token":None,"message":message})
+        return clients.templates.TemplateResponse("home.html", {"request": request, "user_token":None,"message":message})
     else:
         form = await request.form()
-        image_path = None
-        users_ref = firestore_db.collection('twitter_user')
-        username = user_token.get('email').split('@')[0]
-        query = users_ref.where("username", "==", username).limit(1)
-
-        result = query.stream()
-
-        for data in result:
-            user_doc_id = data.id        
-
-        tweets_ref = firestore_db.collection('twitter_user').document(user_doc_id).collection('tweets')
         tweet_data = {
             "tweetText":form['tweetText'] ,
-            "username": username,
-            "email":user_token.get('email'),
-            "date": datetime.utcnow(),                        
+            "username": user.username,
+            "email":user.token.get('email'),
+            "date": datetime.utcnow(),
+            "search_terms": tweet_search.terms(form['tweetText']),
         }
-        tweet_ref = tweets_ref.add(tweet_data)
-        tweet_id = tweet_ref[1].id
         if form['image'].filename:
-            image_path = addFile(form['image'],user_doc_id,tweet_id)
-            # Update the tweet data with the image_url
-            tweet_data["image_url"] = image_path            
-            # Set the tweet document in Firestore with the updated data
-            tweets_ref.document(tweet_id).set(tweet_data)
-        return RedirectResponse("/",status_code=status.HTTP_302_FOUND)
-
-@app.post("/search", response_class=HTMLResponse)
-async def search_users(request:Request,username: str = Form(...)):
-    # Perform search for usernames in Firestore
+            tweet_data["image_url"] = await data_access.run(addFile, clients.media, form['image'], background_tasks)
+        tweet_id = await data_access.run(save_tweet, clients.firestore, user.id, user.data, tweet_data)
+        # Posting can switch the author's fan-out mode, which is stored on their document
+        await data_access.gather(
+            (current_user.invalidate, user.id),
+            (tweets_changed, user.id),
+        )
+        return write_response(request, {"tweetID": tweet_id})
+
+@router.post("/search", response_class=HTMLResponse, dependencies=[rate_limited("search")])
+async def search_users(request:Request,username: str = Form(...), clients: resources.Resources = Depends(get_resources)):
+    # Perform search for usernames in the in-memory directory
     id_token = request.cookies.get("token")
-    user_token = validateFirebaseToken(id_token)
-    username_list = get_username_list()
-    users_ref = firestore_db.collection('twitter_user')
-    query = users_ref.where("username", ">=", username.lower()).where("username", "<=", username.lower() + u"\uf8ff")
-    query_result = query.stream()
+    user_token, username_list, query_result = await data_access.gather(
+        (validateFirebaseToken, clients.token_verifier, id_token),
+        (get_username_list, clients.username_dir),
+        (clients.username_dir.search, username),
+    )
 
     matched_usernames = []
     index = 1
-    for doc in query_result:
-        user_data = doc.to_dict()
-        user_data['id'] = doc.id
+    for user_data in query_result:
         user_data["index"] = index
         matched_usernames.append(user_data)
         index += 1
     if len(matched_usernames) == 0:
         message="No User found"
-        return templates.TemplateResponse("home.html", {"request": request,"userMessage":message,"username":username,"username_list":username_list,"user_token":user_token})
+        return clients.templates.TemplateResponse("home.html", {"request": request,"userMessage":message,"username":username,"username_list":username_list,"user_token":user_token})
     else:
-        return templates.TemplateResponse("home.html", {"request": request, "Search_Data":matched_usernames,"username":username,"username_list":username_list,"user_token":user_token}) 
+        return clients.templates.TemplateResponse("home.html", {"request": request, "Search_Data":matched_usernames,"username":username,"username_list":username_list,"user_token":user_token}) 
+
+
+
+@router.get("/user_profile", response_class=HTMLResponse, dependencies=[rate_limited("user_profile")])
+async def get_user_profile(user_id: str, request: Request, cursor: Optional[str] = None, user: current_user.CurrentUser = Depends(get_current_user),
+                           clients: resources.Resources = Depends(get_resources)):
+    # The viewer's profile stamp covers whether they follow this user
+    viewer_id = user.id if user else None
+    keys = ['profile:' + user_id, 'tweets:' + user_id] + (['profile:' + viewer_id] if user else [])
+    stamps = await data_access.run(versions.read, *keys)
+    key = ('user_profile', viewer_id, user_id, cursor) + page_versions(clients)
+    return await page_cache.respond(request, key, stamps, lambda: render_user_profile(request, clients, user_id, cursor, user), data_access.run)
+
+
+async def render_user_profile(request, clients, user_id, cursor, user):
+    user_token = user.token if user else None
+    calls = [(current_user.get_user, clients.firestore, user_id)]
+    if user:
+        # Check if user_id is in the caller's followings
+        calls.append((follow_graph.is_following, clients.firestore, user.id, user_id))
+    user_data, *following = await data_access.gather(*calls)
+    is_following = bool(following and following[0])
+
+    if user_data is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    user_data["id"] = user_id
+    user_data["follower_count"] = follow_graph.follower_count(user_data)
+    user_data["following_count"] = follow_graph.following_count(user_data)
+    instrumentation.log_sampled("user_profile", user_id=user_id)
+    try:
+        tweets, next_cursor = await get_profile_tweets(clients.firestore, user_id, user_data['username'], cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    return clients.templates.TemplateResponse("user_profile.html", {"request": request, "basic_info": user_data, "tweets": tweets,"user_token":user_token,"is_following":is_following,"next_cursor":next_cursor})
 
 
+def prepare_diffs(media, diffs):
+    attach_image_urls(media, [diff['tweet'] for diff in diffs if diff['op'] == 'upsert'])
+    return diffs
 
-@app.get("/user_profile", response_class=HTMLResponse)
-async def get_user_profile(user_id: str, request: Request): 
 
-    id_token = request.cookies.get("token")
-    user_token = validateFirebaseToken(id_token)
-    users_ref = firestore_db.collection('twitter_user')
-    username = user_token.get('email').split('@')[0]
-    query = users_ref.where("username", "==", username).limit(1)
-    result = query.stream()
-
-    for data in result:
-        data_dict = data.to_dict()  # Convert DocumentSnapshot to dictionary
-        is_following = user_id in data_dict.get('followings', [])  # Check if user_id is in the 'followings' list
-        print("data**********", is_following)
-
-    user_docs = firestore_db.collection("twitter_user").document(user_id).get()
-    user_data = None
-    user_data = user_docs.to_dict()
-    user_data["id"] = user_docs.id
-    print("user dataaaa",user_data)
-    tweets = get_user_tweets(user_id,user_data['username'])
-    
-    return templates.TemplateResponse("user_profile.html", {"request": request, "basic_info": user_data, "tweets": tweets,"user_token":user_token,"is_following":is_following})
+@router.get("/timeline/stream")
+async def timeline_stream(request: Request, user: current_user.CurrentUser = Depends(get_current_user), clients: resources.Resources = Depends(get_resources)):
+    # Server-Sent Events: "timeline" events carry lists of upsert/remove diffs for the home page
+    if not user:
+        raise HTTPException(status_code=401, detail="Not logged in")
+    events = live_updates.stream(clients.timeline_feed, request, user.id, data_access.run, functools.partial(prepare_diffs, clients.media))
+    return StreamingResponse(events, media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# JSON pages for "load more"; pass next_cursor back as cursor to get the following page
+@router.get("/api/timeline", dependencies=[rate_limited("home")])
+async def timeline_page(cursor: Optional[str] = None, user: current_user.CurrentUser = Depends(get_current_user), clients: resources.Resources = Depends(get_resources)):
+    if not user:
+        raise HTTPException(status_code=401, detail="Not logged in")
+    try:
+        timeline, next_cursor = await data_access.run(generate_timeline, clients.firestore, user.id, user.data, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return {"tweets": attach_image_urls(clients.media, timeline), "next_cursor": next_cursor}
+
+
+@router.get("/api/user_profile/{user_id}/tweets", dependencies=[rate_limited("user_profile")])
+async def user_tweets_page(user_id: str, cursor: Optional[str] = None, clients: resources.Resources = Depends(get_resources)):
+    user_data = await data_access.run(current_user.get_user, clients.firestore, user_id)
+    if user_data is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    try:
+        tweets, next_cursor = await get_profile_tweets(clients.firestore, user_id, user_data.get('username'), cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return {"tweets": attach_image_urls(clients.media, tweets), "next_cursor": next_cursor}
+
+
+@router.get("/api/tweetList", dependencies=[rate_limited("tweet_list")])
+async def tweet_list_page(tweet: str, user: str = "all", cursor: Optional[str] = None, clients: resources.Resources = Depends(get_resources)):
+    search_user = None if user == "all" else user
+    try:
+        tweets, next_cursor = await data_access.run(tweet_search.search, clients.firestore, tweet, search_user, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # Matches come newest first, not by relevance
+    return {"tweets": attach_image_urls(clients.media, tweets), "next_cursor": next_cursor, "order": tweet_search.ORDER}
+
 
 
+@router.get("/api/explore", dependencies=[rate_limited("explore")])
+async def explore_feed_page(cursor: Optional[str] = None, clients: resources.Resources = Depends(get_resources)):
+    try:
+        (tweets, next_cursor), trending = await data_access.gather(
+            (explore.explore_page, clients.firestore, cursor),
+            (explore.trending, clients.firestore),
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return {"tweets": attach_image_urls(clients.media, tweets), "next_cursor": next_cursor, "trending": trending}
+
 
-@app.post("/tweetList", response_class=HTMLResponse)
-async def tweet_form(request:Request,user: str = Form(...), tweet: str = Form(...)):
+
+@router.get("/explore", response_class=HTMLResponse, dependencies=[rate_limited("explore")])
+async def explore_feed(request: Request, cursor: Optional[str] = None, clients: resources.Resources = Depends(get_resources)):
+    # Everyone's recent tweets and what is trending, the same page for every viewer
     id_token = request.cookies.get("token")
-    user_token = validateFirebaseToken(id_token)
-    username_list = get_username_list()
-    tweets_ref = firestore_db.collection(f'twitter_user/{user}/tweets')
-    query = tweets_ref.where("tweetText", ">=", tweet.lower()).where("tweetText", "<=", tweet.lower() + u"\uf8ff")
-    
-    query_result = query.stream()
+    try:
+        user_token, username_list, (tweets, next_cursor), trending = await data_access.gather(
+            (validateFirebaseToken, clients.token_verifier, id_token),
+            (get_username_list, clients.username_dir),
+            (explore.explore_page, clients.firestore, cursor),
+            (explore.trending, clients.firestore),
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    attach_image_urls(clients.media, tweets)
+    return clients.templates.TemplateResponse("home.html", {"request": request, "explore_Data": tweets, "trending": trending,"username_list":username_list,"user_token":user_token,"next_cursor":next_cursor})
+
+
+@router.post("/tweetList", response_class=HTMLResponse, dependencies=[rate_limited("tweet_list")])
+async def tweet_form(request:Request,user: str = Form(...), tweet: str = Form(...), cursor: Optional[str] = Form(None), clients: resources.Resources = Depends(get_resources)):
+    id_token = request.cookies.get("token")
+    # "all" searches every user's tweets
+    search_user = None if user == "all" else user
+
+    try:
+        user_token, username_list, (query_result, next_cursor) = await data_access.gather(
+            (validateFirebaseToken, clients.token_verifier, id_token),
+            (get_username_list, clients.username_dir),
+            (tweet_search.search, clients.firestore, tweet, search_user, cursor),
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
     matched_usernames = []
     index = 1
-    for doc in query_result:
-        user_data = doc.to_dict()
-        user_data['id'] = doc.id
+    for user_data in query_result:
         user_data["index"] = index
         matched_usernames.append(user_data)
         index += 1
     if len(matched_usernames) == 0:
         message="No tweet found for this user"
-        return templates.TemplateResponse("home.html", {"request": request,"tweetMessage":message,"tweet":tweet,"selected_user":user,"username_list":username_list,"user_token":user_token})
+        return clients.templates.TemplateResponse("home.html", {"request": request,"tweetMessage":message,"tweet":tweet,"selected_user":user,"username_list":username_list,"user_token":user_token})
     else:        
-        return templates.TemplateResponse("home.html", {"request": request, "tweet_Data":matched_usernames,"tweet":tweet,"selected_user":user,"username_list":username_list,"user_token":user_token})
+        return clients.templates.TemplateResponse("home.html", {"request": request, "tweet_Data":matched_usernames,"tweet":tweet,"selected_user":user,"username_list":username_list,"user_token":user_token,"next_cursor":next_cursor,
+                                                                "tweet_order":"Newest matches first"})
         # return RedirectResponse("/",status_code=status.HTTP_302_FOUND)
 
-@app.post("/follow/{following_id}")
-def follow_user(request:Request,following_id: str):
-    print("following_id",following_id)
-    id_token = request.cookies.get("token")
-    user_token = validateFirebaseToken(id_token)
-    users_ref = firestore_db.collection('twitter_user')
-    username = user_token.get('email').split('@')[0]
-    query = users_ref.where("username", "==", username).limit(1)
-
-    result = query.stream()
-
-    for data in result:
-        follower_id = data.id
-    
-    print("follower id",follower_id)
-    # Check if the follower and following users exist
-    follower_ref = firestore_db.collection('twitter_user').document(follower_id).get()
-    following_ref = firestore_db.collection('twitter_user').document(following_id).get()
-    if not follower_ref.exists:
+@router.post("/follow/{following_id}")
+def follow_user(request:Request,following_id: str, user: current_user.CurrentUser = Depends(get_current_user), clients: resources.Resources = Depends(get_resources)):
+    if not user:
         raise HTTPException(status_code=404, detail="Follower not found")
-    if not following_ref.exists:
-        raise HTTPException(status_code=404, detail="Following not found")
+    follower_id = user.id
 
-    # Update follower's following list
-    firestore_db.collection('twitter_user').document(follower_id).update({
-        'followings': firestore.ArrayUnion([following_id])
-    })
+    instrumentation.log_sampled("follow", follower_id=follower_id, following_id=following_id)
+    # Check the following user exists
+    db = clients.firestore
+    following_data = current_user.get_user(db, following_id)
+    if following_data is None:
+        raise HTTPException(status_code=404, detail="Following not found")
+    following_data = follow_graph.migrate_legacy(db, following_id, following_data)
 
-    # Update following's followers list
-    firestore_db.collection('twitter_user').document(following_id).update({
-        'followers': firestore.ArrayUnion([follower_id])
-    })
+    # Add both edges and counters in one batched write, then update the timeline
+    timeline_store.follow_author(db, follower_id, following_id, following_data)
+    timeline_store.large_authors_cache.invalidate(follower_id)
+    current_user.invalidate(user.id, following_id)
 
     # return templates.TemplateResponse("user_profile.html", {"request": request,"message": "User followed successfully","user_token":user_token})
     return {"message": "User followed successfully"}
 
 # Define the unfollow endpoint
-@app.post("/unfollow/{following_id}")
-def follow_user(request:Request,following_id: str):
-    print("following_id",following_id)
-    id_token = request.cookies.get("token")
-    user_token = validateFirebaseToken(id_token)
-    users_ref = firestore_db.collection('twitter_user')
-    username = user_token.get('email').split('@')[0]
-    query = users_ref.where("username", "==", username).limit(1)
-
-    result = query.stream()
+@router.post("/unfollow/{following_id}")
+def follow_user(request:Request,following_id: str, user: current_user.CurrentUser = Depends(get_current_user), clients: resources.Resources = Depends(get_resources)):
+    if not user:
+        raise HTTPException(status_code=404, detail="Follower not found")
+    follower_id = user.id
 
-    for data in result:
-        follower_id = data.id
-    
-    print("follower id",follower_id)
+    instrumentation.log_sampled("unfollow", follower_id=follower_id, following_id=following_id)
 
-    # Check if both users exist
-    follower_ref = firestore_db.collection('twitter_user').document(follower_id).get()
-    following_ref = firestore_db.collection('twitter_user').document(following_id).get()
-    if not follower_ref.exists:
-        raise HTTPException(status_code=404, detail="Follower not found")
-    if not following_ref.exists:
+    # Check the following user exists
+    db = clients.firestore
+    following_data = current_user.get_user(db, following_id)
+    if following_data is None:
         raise HTTPException(status_code=404, detail="Following not found")
+    following_data = follow_graph.migrate_legacy(db, following_id, following_data)
 
-    # Update follower's following list
-    firestore_db.collection('twitter_user').document(follower_id).update({
-        'followings': firestore.ArrayRemove([following_id])
-    })
-
-    # Update following's followers list
-    firestore_db.collection('twitter_user').document(following_id).update({
-        'followers': firestore.ArrayRemove([follower_id])
-    })
+    # Remove both edges and counters in one batched write, then update the timeline
+    timeline_store.unfollow_author(db, follower_id, following_id, following_data)
+    timeline_store.large_authors_cache.invalidate(follower_id)
+    current_user.invalidate(user.id, following_id)
 
     return {"message": "User unfollowed successfully"}
 
 
-@app.post("/editTweet")
-async def edit_tweet(tweetId: str = Form(...),userId: str = Form(...), content: str = Form(...),update_image: UploadFile = File(None)):
-    # Dummy function to simulate editing a tweet
-    print("tweetid",tweetId)
-    print("userId",userId)
-    print("content",content)
-    # print("file",update_image)
-    tweets_ref = firestore_db.collection(f'twitter_user/{userId}/tweets')
+def update_tweet(db, userId, tweetId, content, image_path):
+    tweets_ref = db.collection(f'twitter_user/{userId}/tweets')
     tweet_doc_ref = tweets_ref.document(tweetId)
-    image_path = addFile(update_image,userId,tweetId)
-    if not tweet_doc_ref.get().exists:
+    changes = {"tweetText": content, "search_terms": tweet_search.terms(content)}
+    # Keep the current image unless a new one was uploaded
+    if image_path:
+        changes["image_url"] = image_path
+    # The trending counters need the text being replaced, so the tweet is read
+    # first and only updated if no other write has changed it since
+    tweet = tweet_doc_ref.get(field_paths=['tweetText', 'date'])
+    if not tweet.exists:
         raise HTTPException(status_code=404, detail="Tweet not found")
-    tweet_doc_ref.update({"tweetText": content,"image_url": image_path})
+    try:
+        tweet_doc_ref.update(changes, option=db.write_option(last_update_time=tweet.update_time))
+    except FailedPrecondition:
+        raise HTTPException(status_code=409, detail="Tweet was changed or deleted meanwhile, try again")
+    author_data = current_user.get_user(db, userId)
+    timeline_store.revise_tweet(db, userId, author_data, tweetId, changes)
+    tweets_changed(userId)
+    explore.recount_tweet(db, tweet.get('tweetText'), content, tweet.get('date'))
+
+@router.post("/editTweet")
+async def edit_tweet(request: Request, background_tasks: BackgroundTasks, tweetId: str = Form(...),userId: str = Form(...), content: str = Form(...),update_image: UploadFile = File(None),
+                     clients: resources.Resources = Depends(get_resources)):
+    # Dummy function to simulate editing a tweet
+    instrumentation.log_sampled("edit_tweet", tweet_id=tweetId, user_id=userId)
+    # print("file",update_image)
+    image_path = None
+    if update_image and update_image.filename:
+        image_path = await data_access.run(addFile, clients.media, update_image, background_tasks)
+    await data_access.run(update_tweet, clients.firestore, userId, tweetId, content, image_path)
     # return {"message": "Tweet edited successfully"}
-    return RedirectResponse("/",status_code=status.HTTP_302_FOUND)
+    return write_response(request, {"tweetID": tweetId})
 
-@app.post("/edit_profile_image")
-async def edit_tweet(request:Request):
+@router.post("/edit_profile_image")
+async def edit_tweet(request:Request, background_tasks: BackgroundTasks, clients: resources.Resources = Depends(get_resources)):
 # async def edit_tweet(request:Request,userId: str = Form(...),profile_image: UploadFile = File(None)):
     # Dummy function to simulate editing a tweet
     form = await request.form()
-    tweetId =None
-    print("userId",form['userID'])
-    print("profile_image",form['profile_image'])
+    instrumentation.log_sampled("edit_profile_image", user_id=form['userID'])
     
-    image_path = addFile(form['profile_image'],form['userID'],tweetId)
-    firestore_db.collection('twitter_user').document(form['userID']).update({
+    image_path = await data_access.run(addFile, clients.media, form['profile_image'], background_tasks)
+    await data_access.run(clients.firestore.collection('twitter_user').document(form['userID']).update, {
         'profile_url': image_path
     })
+    await data_access.run(current_user.invalidate, form['userID'])
     # return {"message": "Tweet edited successfully"}
-    return RedirectResponse("/",status_code=status.HTTP_302_FOUND)
+    return write_response(request, {"profile_url": clients.media.url(image_path)})
 
-@app.post("/deleteTweet")
-async def delete_tweet(userId: str = Form(...), tweetId: str = Form(...)):
-    # Delete tweet from Firestore
-    tweets_ref = firestore_db.collection(f'twitter_user/{userId}/tweets')
+def remove_tweet(db, userId, tweetId):
+    tweets_ref = db.collection(f'twitter_user/{userId}/tweets')
     tweet_doc_ref = tweets_ref.document(tweetId)
-    if not tweet_doc_ref.get().exists:
+    # The trending counters need the text and date of the tweet being removed
+    tweet = tweet_doc_ref.get(field_paths=['tweetText', 'date'])
+    if not tweet.exists:
         raise HTTPException(status_code=404, detail="Tweet not found")
-    tweet_doc_ref.delete()
-    # return {"message": "Tweet deleted successfully"}
-    return RedirectResponse("/",status_code=status.HTTP_302_FOUND)
-
-def get_username_from_id(user_id):
-    user_doc_ref = firestore_db.collection('twitter_user').document(user_id)
-    user_data = user_doc_ref.get().to_dict()
-    
-    # Extract username from user data
-    if user_data:
-        return user_data.get('username')
-    else:
-        return None
+    try:
+        # Fails if a concurrent delete got there first, so the tweet is uncounted once
+        tweet_doc_ref.delete(option=db.write_option(exists=True))
+    except NotFound:
+        raise HTTPException(status_code=404, detail="Tweet not found")
+    author_data = current_user.get_user(db, userId)
+    timeline_store.retract_tweet(db, userId, author_data, tweetId)
+    tweets_changed(userId)
+    explore.count_tweet(db, tweet.get('tweetText'), tweet.get('date'), -1)
 
-@app.get("/profile", response_class=HTMLResponse)
-async def profile_page(request: Request):
-    id_token = request.cookies.get("token")
-    user_token = validateFirebaseToken(id_token)
-    if user_token:
-        users_ref = firestore_db.collection('twitter_user')
-        username = user_token.get('email').split('@')[0]
-        query = users_ref.where("username", "==", username).limit(1)
-        result = query.stream()
-        
-        userData = []
-        followingData = []
-        followerData = []
-        for data in result:
-            data_dict = data.to_dict()  
-            followings = data_dict.get('followings', [])
-            for following_id in followings:
-                followingData.append(get_username_from_id(following_id))
-            data_dict['followings']=followingData
-            data_dict['userId']= data.id
-            data_dict['following_count']=len(followings) if followings else 0
-            followers = data_dict.get('followers', [])
-            for follower_id in followers:
-                followerData.append(get_username_from_id(follower_id))
-            data_dict['followers']=followerData
-            data_dict['follower_count']=len(followers) if followers else 0
-            userData.append(data_dict)
-            
-            image_path = downloadBlob(userData)
-            print("data**********", userData,image_path)
-            if len(image_path) > 0 :
-                image_path = image_path[0]['image_url']
-            else:
-                image_path = os.path.join('static', 'user.png')
-            # print("image path",image_path[0]['image_url'])
-
-    return templates.TemplateResponse("profile.html", {"request": request, "profile": userData,"user_token":user_token,"image_path":image_path})
-
-@app.get("/login", response_class=HTMLResponse)
-async def root(request: Request):
+@router.post("/deleteTweet")
+async def delete_tweet(request: Request, userId: str = Form(...), tweetId: str = Form(...), clients: resources.Resources = Depends(get_resources)):
+    # Delete tweet from Firestore
+    await data_access.run(remove_tweet, clients.firestore, userId, tweetId)
+    # return {"message": "Tweet deleted successfully"}
+    return write_response(request, {"tweetID": tweetId})
+
+# Followers/followings shown per page on the profile
+FOLLOW_PAGE_SIZE = 50
+# Documents fetched per batched get_all call
+GET_ALL_CHUNK_SIZE = 100
+
+def get_usernames_from_ids(clients, user_ids):
+    # Most users are already in the username directory; batch-read the rest
+    names = {}
+    missing = []
+    for user_id in user_ids:
+        user = clients.username_dir.get(user_id)
+        if user:
+            names[user_id] = user['username']
+        else:
+            missing.append(user_id)
+
+    users_ref = clients.firestore.collection('twitter_user')
+    for start in range(0, len(missing), GET_ALL_CHUNK_SIZE):
+        refs = [users_ref.document(user_id) for user_id in missing[start:start + GET_ALL_CHUNK_SIZE]]
+        for snapshot in clients.firestore.get_all(refs, field_paths=['username']):
+            names[snapshot.id] = snapshot.get('username') if snapshot.exists else None
+    return [names.get(user_id) for user_id in user_ids]
+
+
+@router.get("/profile", response_class=HTMLResponse, dependencies=[rate_limited("profile")])
+async def profile_page(request: Request, followings_cursor: Optional[str] = None, followers_cursor: Optional[str] = None, user: current_user.CurrentUser = Depends(get_current_user),
+                       clients: resources.Resources = Depends(get_resources)):
+    if not user:
+        return RedirectResponse("/login", status_code=status.HTTP_302_FOUND)
+    # Follows and unfollows on either side bump the profile stamp
+    stamps = await data_access.run(versions.read, 'profile:' + user.id)
+    key = ('profile', user.id, followings_cursor, followers_cursor) + page_versions(clients)
+    return await page_cache.respond(request, key, stamps, lambda: render_profile(request, clients, followings_cursor, followers_cursor, user, stamps), data_access.run)
+
+
+async def profile_follows(clients, user_id, followings_cursor, followers_cursor):
+    """Return the followings and followers pages as (names, next_cursor) pairs."""
+    (following_ids, next_followings), (follower_ids, next_followers) = await data_access.gather(
+        (follow_graph.list_page, follow_graph.followings_ref(clients.firestore, user_id), FOLLOW_PAGE_SIZE, followings_cursor),
+        (follow_graph.list_page, follow_graph.followers_ref(clients.firestore, user_id), FOLLOW_PAGE_SIZE, followers_cursor),
+    )
+    followings, followers = await data_access.gather(
+        (get_usernames_from_ids, clients, following_ids),
+        (get_usernames_from_ids, clients, follower_ids),
+    )
+    return (followings, next_followings), (followers, next_followers)
+
+
+async def render_profile(request, clients, followings_cursor, followers_cursor, user, stamps):
+    user_token = user.token
+    userData = []
+    data_dict = dict(user.data)
+    (followingData, data_dict['followings_cursor']), (followerData, data_dict['followers_cursor']) = await page_cache.fragment(
+        ('follows', user.id, followings_cursor, followers_cursor), stamps,
+        lambda: profile_follows(clients, user.id, followings_cursor, followers_cursor), data_access.run)
+    data_dict['followings']=followingData
+    data_dict['userId']= user.id
+    data_dict['following_count']=follow_graph.following_count(data_dict)
+    data_dict['followers']=followerData
+    data_dict['follower_count']=follow_graph.follower_count(data_dict)
+    userData.append(data_dict)
+
+    image_path = clients.media.url(data_dict.get('profile_url'))
+    instrumentation.log_sampled("profile", user_id=user.id, image_path=image_path)
+    if not image_path:
+        image_path = os.path.join('static', 'user.png')
+
+    return clients.templates.TemplateResponse("profile.html", {"request": request, "profile": userData,"user_token":user_token,"image_path":image_path})
+
+@router.get("/login", response_class=HTMLResponse)
+async def root(request: Request, clients: resources.Resources = Depends(get_resources)):
 
     id_token = request.cookies.get("token")
     error_message = "No error here"
-    user_token = None
+    user_token = await data_access.run(validateFirebaseToken, clients.token_verifier, id_token)
+
+    return clients.templates.TemplateResponse('login.html', {'request': request, 'user_token': user_token, 'error_message': error_message})
 
-    if id_token:
-        try:
-            user_token = google.oauth2.id_token.verify_firebase_token(id_token, firebase_request_adapter)
-        except ValueError as err:
-            print(str(err))
 
-    return templates.TemplateResponse('login.html', {'request': request, 'user_token': user_token, 'error_message': error_message})
\ No newline at end of file
+# Served with e.g. uvicorn main:app
+app = create_app()
\ No newline at end of file
@@ -0,0 +1,52 @@
+import os
+import time
+from datetime import timedelta
+
+from ttl_cache import TTLCache
+
+# Serve signed URLs instead of public ones (needs credentials that can sign)
+SIGNED_URLS = os.environ.get("MEDIA_SIGNED_URLS", "") == "1"
+
+# How long a signed URL stays valid, and how long a resolved URL is reused
+SIGNED_URL_EXPIRY = timedelta(hours=1)
+URL_TTL = 30 * 60
+
+
+class MediaUrls:
+    """Turns stored object paths into browser URLs without calling Storage.
+
+    Objects are made public when they are uploaded, so a public URL is just
+    the bucket and path. Signed URLs are computed locally from the client's
+    credentials.
+    """
+
+    def __init__(self, client, bucket_name, signed=SIGNED_URLS):
+        # One client, and so one authorized HTTP session, for the whole worker
+        self.client = client
+        self.bucket = client.bucket(bucket_name)
+        self.signed = signed
+        self.urls = TTLCache(ttl=URL_TTL)
+
+    def epoch(self):
+        """Changes whenever previously handed out URLs may stop working."""
+        if not self.signed:
+            return 0
+        # Cached signed URLs have at least SIGNED_URL_EXPIRY - URL_TTL left within one epoch
+        return int(time.time() // URL_TTL)
+
+    def url(self, path):
+        if not path:
+            return None
+        url = self.urls.get(path)
+        if url is None:
+            blob = self.bucket.blob(path)
+            if self.signed:
+                url = blob.generate_signed_url(version="v4", expiration=SIGNED_URL_EXPIRY)
+            else:
+                url = blob.public_url
+            self.urls.set(path, url)
+        return url
+
+    def tweet_image_urls(self, tweets):
+        """Return {tweetID: url} for the tweets that have an image."""
+        return {tweet['tweetID']: self.url(tweet['image_url']) for tweet in tweets if tweet.get('image_url')}
@@ -0,0 +1,767 @@
+"""In-memory stand-ins for the Firestore, Storage and Firebase auth clients.
+
+They implement the subset of the client APIs this app uses, keep everything
+in process memory and count every RPC the real clients would have issued in
+``stats``, so handlers can be exercised and measured without GCP.
+"""
+import functools
+import threading
+import time
+import uuid
+import queue
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from urllib.parse import quote
+
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound, PreconditionFailed
+from google.cloud.firestore_v1 import transforms
+
+# RPC and document counters, e.g. stats['firestore.get'] or stats['firestore.docs_read']
+stats = Counter()
+stats_lock = threading.Lock()
+# Called with (name, amount) for every recorded counter, e.g. by instrumentation
+listeners = []
+
+
+def record(name, amount=1):
+    with stats_lock:
+        stats[name] += amount
+    for listener in listeners:
+        listener(name, amount)
+
+
+def reset_stats():
+    with stats_lock:
+        stats.clear()
+
+
+def snapshot_stats():
+    with stats_lock:
+        return Counter(stats)
+
+
+# Firestore
+
+DESCENDING = "DESCENDING"
+
+
+def _normalize(value):
+    # Firestore hands datetimes back as timezone-aware UTC values
+    if isinstance(value, datetime) and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def _get_field(data, field_path):
+    value = data
+    for part in field_path.split('.'):
+        value = value[part]
+    return value
+
+
+def _apply(data, field_path, value):
+    parts = field_path.split('.')
+    target = data
+    for part in parts[:-1]:
+        target = target.setdefault(part, {})
+    key = parts[-1]
+    if value is transforms.DELETE_FIELD:
+        target.pop(key, None)
+    elif value is transforms.SERVER_TIMESTAMP:
+        target[key] = datetime.now(timezone.utc)
+    elif isinstance(value, transforms.Increment):
+        target[key] = target.get(key, 0) + value.value
+    elif isinstance(value, transforms.ArrayUnion):
+        current = list(target.get(key, []))
+        current.extend(item for item in value.values if item not in current)
+        target[key] = current
+    elif isinstance(value, transforms.ArrayRemove):
+        target[key] = [item for item in target.get(key, []) if item not in value.values]
+    else:
+        target[key] = _normalize(value)
+
+
+def _merge(data, updates):
+    for key, value in updates.items():
+        if isinstance(value, dict):
+            # Nested maps can hold transforms such as Increment, so build them up the same way
+            if not isinstance(data.get(key), dict):
+                data[key] = {}
+            _merge(data[key], value)
+        else:
+            _apply(data, key, value)
+
+
+class DocumentSnapshot:
+
+    def __init__(self, reference, data, field_paths=None, update_time=None):
+        self.reference = reference
+        self.exists = data is not None
+        self.update_time = update_time
+        if data is not None and field_paths is not None:
+            data = {key: value for key, value in data.items() if key in field_paths}
+        self._data = data
+
+    @property
+    def id(self):
+        return self.reference.id
+
+    def to_dict(self):
+        if self._data is None:
+            return None
+        return _copy(self._data)
+
+    def get(self, field_path):
+        if self._data is None:
+            return None
+        return _copy(_get_field(self._data, field_path))
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+
+class DocumentReference:
+
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+
+    @property
+    def id(self):
+        return self.path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        return CollectionReference(self._client, self.path.rsplit('/', 1)[0])
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def collection(self, collection_id):
+        return CollectionReference(self._client, self.path + '/' + collection_id)
+
+    def get(self, field_paths=None):
+        record('firestore.get')
+        data, update_time = self._client._read_versioned(self.path)
+        record('firestore.docs_read')
+        return DocumentSnapshot(self, data, field_paths, update_time)
+
+    def set(self, document_data, merge=False):
+        batch = self._client.batch()
+        batch.set(self, document_data, merge=merge)
+        batch.commit()
+
+    def create(self, document_data):
+        batch = self._client.batch()
+        batch.create(self, document_data)
+        batch.commit()
+
+    def update(self, field_updates, option=None):
+        batch = self._client.batch()
+        batch.update(self, field_updates, option=option)
+        batch.commit()
+
+    def delete(self, option=None):
+        batch = self._client.batch()
+        batch.delete(self, option=option)
+        batch.commit()
+
+    def on_snapshot(self, callback):
+        return self._client._watch(lambda path, data: path == self.path, callback)
+
+
+class Query:
+
+    def __init__(self, client, path, all_descendants=False):
+        self._client = client
+        self._path = path
+        self._all_descendants = all_descendants
+        self._filters = []
+        self._orders = []
+        self._limit = None
+        self._fields = None
+        self._start_after = None
+
+    def _copy(self, **changes):
+        query = Query(self._client, self._path, self._all_descendants)
+        query._filters = list(self._filters)
+        query._orders = list(self._orders)
+        query._limit = self._limit
+        query._fields = self._fields
+        query._start_after = self._start_after
+        for key, value in changes.items():
+            setattr(query, '_' + key, value)
+        return query
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + [(field_path, op_string, _normalize(value))])
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        return self._copy(orders=self._orders + [(field_path, direction)])
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    def start_after(self, document_fields):
+        if isinstance(document_fields, DocumentSnapshot):
+            values = document_fields.to_dict()
+            values['__name__'] = document_fields.reference
+        else:
+            values = dict(document_fields)
+        cursor = []
+        for field_path, _ in self._orders[:len(values)]:
+            value = values[field_path]
+            if field_path == '__name__' and isinstance(value, str):
+                value = self._client.document(self._path + '/' + value) if '/' not in value else self._client.document(value)
+            cursor.append(_normalize(value))
+        return self._copy(start_after=cursor)
+
+    def _matches_parent(self, path):
+        parent = path.rsplit('/', 1)[0]
+        if self._all_descendants:
+            return parent.rsplit('/', 1)[-1] == self._path
+        return parent == self._path
+
+    def _candidates(self):
+        if self._all_descendants:
+            return self._client._scan_group(self._path)
+        return self._client._scan(self._path)
+
+    def _value(self, path, data, field_path):
+        if field_path == '__name__':
+            return path
+        return _get_field(data, field_path)
+
+    def _passes(self, path, data):
+        for field_path, op, expected in self._filters:
+            try:
+                value = self._value(path, data, field_path)
+            except (KeyError, TypeError):
+                return False
+            if op == '==' and not value == expected:
+                return False
+            if op == '!=' and not value != expected:
+                return False
+            if op in ('<', '<=', '>', '>=') and (type(value) is not type(expected) or not {
+                    '<': value < expected, '<=': value <= expected,
+                    '>': value > expected, '>=': value >= expected}[op]):
+                return False
+            if op == 'array_contains' and not (isinstance(value, list) and expected in value):
+                return False
+            if op == 'array_contains_any' and not (isinstance(value, list) and any(item in value for item in expected)):
+                return False
+            if op == 'in' and value not in expected:
+                return False
+        for field_path, _ in self._orders:
+            try:
+                self._value(path, data, field_path)
+            except (KeyError, TypeError):
+                return False
+        return True
+
+    def _sort_key(self, path, data):
+        return [self._value(path, data, field_path) for field_path, _ in self._orders]
+
+    def _compare(self, left, right):
+        for (field_path, direction), a, b in zip(self._orders, left, right):
+            if isinstance(a, DocumentReference):
+                a = a.path
+            if isinstance(b, DocumentReference):
+                b = b.path
+            if a == b:
+                continue
+            result = -1 if a < b else 1
+            return -result if direction == DESCENDING else result
+        return 0
+
+    def _run(self):
+        record('firestore.query')
+        documents = [(path, data) for path, data in self._candidates() if self._passes(path, data)]
+        if self._orders:
+            documents.sort(key=functools.cmp_to_key(lambda a, b: self._compare(self._sort_key(*a), self._sort_key(*b))))
+        else:
+            documents.sort(key=lambda item: item[0])
+        if self._start_after is not None:
+            cursor = self._start_after
+            documents = [item for item in documents if self._compare(self._sort_key(*item)[:len(cursor)], cursor) > 0]
+        if self._limit is not None:
+            documents = documents[:self._limit]
+        record('firestore.docs_read', max(len(documents), 1))
+        return [DocumentSnapshot(self._client.document(path), data, self._fields) for path, data in documents]
+
+    def stream(self):
+        return iter(self._run())
+
+    def get(self):
+        return self._run()
+
+    def on_snapshot(self, callback):
+        # Removals carry no data; filters only apply to documents that still exist
+        return self._client._watch(
+            lambda path, data: self._matches_parent(path) and (data is None or self._passes(path, data)), callback)
+
+
+class CollectionReference(Query):
+
+    def __init__(self, client, path):
+        super().__init__(client, path)
+
+    @property
+    def id(self):
+        return self._path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        if '/' not in self._path:
+            return None
+        return DocumentReference(self._client, self._path.rsplit('/', 1)[0])
+
+    def document(self, document_id=None):
+        if document_id is None:
+            document_id = uuid.uuid4().hex[:20]
+        return DocumentReference(self._client, self._path + '/' + document_id)
+
+    def add(self, document_data):
+        reference = self.document()
+        reference.set(document_data)
+        return datetime.now(timezone.utc), reference
+
+
+class WriteBatch:
+
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(('set', reference, document_data, merge))
+
+    def create(self, reference, document_data):
+        self._writes.append(('create', reference, document_data, None))
+
+    def update(self, reference, field_updates, option=None):
+        self._writes.append(('update', reference, field_updates, option))
+
+    def delete(self, reference, option=None):
+        self._writes.append(('delete', reference, None, option))
+
+    def commit(self):
+        record('firestore.commit')
+        record('firestore.docs_written', len(self._writes))
+        self._client._commit(self._writes)
+        self._writes = []
+
+
+class BulkWriter:
+    """Queues writes and applies them on flush, reporting failures like the real BulkWriter."""
+
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+        self._on_error = lambda failure, writer: False
+
+    def on_write_error(self, callback):
+        self._on_error = callback
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(('set', reference, document_data, merge))
+
+    def create(self, reference, document_data):
+        self._writes.append(('create', reference, document_data, None))
+
+    def update(self, reference, field_updates, option=None):
+        self._writes.append(('update', reference, field_updates, option))
+
+    def delete(self, reference, option=None):
+        self._writes.append(('delete', reference, None, option))
+
+    def flush(self):
+        writes, self._writes = self._writes, []
+        if writes:
+            # The real writer sends up to 20 writes per batch_write RPC
+            record('firestore.batch_write', (len(writes) + 19) // 20)
+        for write in writes:
+            attempts = 0
+            while True:
+                attempts += 1
+                try:
+                    self._client._commit([write])
+                    record('firestore.docs_written')
+                    break
+                except (AlreadyExists, FailedPrecondition, NotFound, PreconditionFailed) as err:
+                    operation = SimpleNamespace(reference=write[1], attempts=attempts)
+                    failure = SimpleNamespace(operation=operation, attempts=attempts, code=err.grpc_status_code, message=str(err))
+                    if not self._on_error(failure, self):
+                        break
+
+    def close(self):
+        self.flush()
+
+
+class MemoryFirestore:
+    """A Firestore client whose database is a dict of document path to data."""
+
+    def __init__(self, project=None):
+        self.project = project
+        # Collection path -> {document id: data}
+        self._collections = {}
+        # Document path -> time of its last write, for last_update_time preconditions
+        self._update_times = {}
+        self._last_update_time = None
+        self._lock = threading.RLock()
+        self._watches = []
+
+    def collection(self, path):
+        return CollectionReference(self, path)
+
+    def collection_group(self, collection_id):
+        return Query(self, collection_id, all_descendants=True)
+
+    def document(self, path):
+        return DocumentReference(self, path)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def bulk_writer(self, options=None):
+        return BulkWriter(self)
+
+    def close(self):
+        # Shared by every app instance in the process; each app's Resources.close()
+        # has already stopped its own listeners, so there is nothing to release
+        pass
+
+    def write_option(self, exists=None, last_update_time=None):
+        return SimpleNamespace(exists=exists, last_update_time=last_update_time)
+
+    def get_all(self, references, field_paths=None):
+        references = list(references)
+        record('firestore.get_all')
+        record('firestore.docs_read', len(references))
+        for reference in references:
+            data, update_time = self._read_versioned(reference.path)
+            yield DocumentSnapshot(reference, data, field_paths, update_time)
+
+    def _read(self, path):
+        parent, document_id = path.rsplit('/', 1)
+        with self._lock:
+            data = self._collections.get(parent, {}).get(document_id)
+            return _copy(data) if data is not None else None
+
+    def _read_versioned(self, path):
+        with self._lock:
+            return self._read(path), self._update_times.get(path)
+
+    def _next_update_time(self):
+        # Strictly increasing, so two commits in the same microsecond still differ
+        now = datetime.now(timezone.utc)
+        if self._last_update_time is not None and now <= self._last_update_time:
+            now = self._last_update_time + timedelta(microseconds=1)
+        self._last_update_time = now
+        return now
+
+    def _scan(self, parent):
+        with self._lock:
+            return [(parent + '/' + document_id, _copy(data)) for document_id, data in self._collections.get(parent, {}).items()]
+
+    def _scan_group(self, collection_id):
+        with self._lock:
+            return [(parent + '/' + document_id, _copy(data))
+                    for parent, documents in self._collections.items() if parent.rsplit('/', 1)[-1] == collection_id
+                    for document_id, data in documents.items()]
+
+    def _exists(self, path):
+        parent, document_id = path.rsplit('/', 1)
+        return document_id in self._collections.get(parent, {})
+
+    def _documents(self, path):
+        parent, document_id = path.rsplit('/', 1)
+        return self._collections.setdefault(parent, {}), document_id
+
+    def _commit(self, writes):
+        with self._lock:
+            # Check every precondition first so a failed batch changes nothing
+            for kind, reference, _, option in writes:
+                exists = self._exists(reference.path)
+                if kind == 'create' and exists:
+                    raise AlreadyExists("Document already exists: " + reference.path)
+                last_update_time = getattr(option, 'last_update_time', None)
+                if last_update_time is not None and self._update_times.get(reference.path) != last_update_time:
+                    # Also how a document deleted since it was read fails
+                    raise FailedPrecondition("Document changed since it was read: " + reference.path)
+                if kind == 'update' and not exists:
+                    raise NotFound("No document to update: " + reference.path)
+                if kind == 'delete' and option is not None and option.exists and not exists:
+                    raise NotFound("No document to delete: " + reference.path)
+
+            changes = []
+            update_time = self._next_update_time()
+            for kind, reference, data, option in writes:
+                documents, document_id = self._documents(reference.path)
+                existed = document_id in documents
+                if kind == 'delete':
+                    if existed:
+                        del documents[document_id]
+                        del self._update_times[reference.path]
+                        changes.append(('REMOVED', reference, None))
+                    continue
+                if kind == 'update' or (kind == 'set' and option):
+                    document = documents.get(document_id, {})
+                    _merge(document, data)
+                else:
+                    document = {}
+                    _merge(document, data)
+                documents[document_id] = document
+                self._update_times[reference.path] = update_time
+                changes.append(('MODIFIED' if existed else 'ADDED', reference, _copy(document)))
+        self._notify(changes)
+
+    def _watch(self, matches, callback):
+        watch = Watch(self, matches, callback)
+        with self._lock:
+            self._watches.append(watch)
+            initial = [('ADDED', self.document(parent + '/' + document_id), _copy(data))
+                       for parent, documents in self._collections.items()
+                       for document_id, data in documents.items() if matches(parent + '/' + document_id, data)]
+        record('firestore.listen')
+        watch.push(initial)
+        return watch
+
+    def _notify(self, changes):
+        for watch in list(self._watches):
+            relevant = [change for change in changes if watch.matches(change[1].path, change[2])]
+            if relevant:
+                watch.push(relevant)
+
+
+class Watch:
+    """Delivers snapshot callbacks on a background thread, like the real listener."""
+
+    def __init__(self, client, matches, callback):
+        self._client = client
+        self.matches = matches
+        self._callback = callback
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="memory-watch", daemon=True)
+        self._thread.start()
+
+    def push(self, changes):
+        self._queue.put(changes)
+
+    def _run(self):
+        while True:
+            changes = self._queue.get()
+            if changes is None:
+                return
+            documents = [DocumentSnapshot(reference, data) for _, reference, data in changes]
+            change_list = [SimpleNamespace(type=SimpleNamespace(name=kind), document=document)
+                           for (kind, _, _), document in zip(changes, documents)]
+            record('firestore.docs_read', len(documents))
+            self._callback(documents, change_list, datetime.now(timezone.utc))
+
+    def unsubscribe(self):
+        with self._client._lock:
+            if self in self._client._watches:
+                self._client._watches.remove(self)
+        self._queue.put(None)
+
+
+# Cloud Storage
+
+class MemoryBlob:
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = None
+
+    @property
+    def public_url(self):
+        return "https://storage.googleapis.com/{}/{}".format(self.bucket.name, quote(self.name))
+
+    def generate_signed_url(self, **kwargs):
+        return self.public_url + "?X-Goog-Signature=memory"
+
+    def exists(self):
+        record('storage.exists')
+        return self.name in self.bucket.objects
+
+    def upload_from_file(self, file, size=None, content_type=None, predefined_acl=None, if_generation_match=None, **kwargs):
+        record('storage.upload')
+        data = file.read() if size is None else file.read(size)
+        with self.bucket.lock:
+            if if_generation_match == 0 and self.name in self.bucket.objects:
+                raise PreconditionFailed("Object already exists: " + self.name)
+            self.bucket.objects[self.name] = data
+        record('storage.bytes_uploaded', len(data))
+
+    def upload_from_string(self, data, content_type=None, **kwargs):
+        record('storage.upload')
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        with self.bucket.lock:
+            self.bucket.objects[self.name] = data
+        record('storage.bytes_uploaded', len(data))
+
+    def make_public(self):
+        record('storage.acl')
+
+    def delete(self):
+        record('storage.delete')
+        with self.bucket.lock:
+            if self.bucket.objects.pop(self.name, None) is None:
+                raise NotFound("No such object: " + self.name)
+
+
+class MemoryBucket:
+
+    def __init__(self, name):
+        self.name = name
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def blob(self, blob_name):
+        return MemoryBlob(self, blob_name)
+
+
+class MemoryStorage:
+    """A Storage client whose buckets are dicts of object name to bytes."""
+
+    def __init__(self, project=None):
+        self.project = project
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, bucket_name):
+        with self.lock:
+            if bucket_name not in self.buckets:
+                self.buckets[bucket_name] = MemoryBucket(bucket_name)
+            return self.buckets[bucket_name]
+
+    def close(self):
+        pass
+
+
+# Redis
+
+class MemoryRedis:
+    """The few Redis commands the shared cache uses, on a dict with expiry times."""
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _live(self, key):
+        entry = self.values.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self.values[key]
+            return None
+        return entry
+
+    def get(self, key):
+        record('cache.get')
+        with self.lock:
+            entry = self._live(key)
+            return entry[0] if entry else None
+
+    def set(self, key, value, px=None, nx=False):
+        record('cache.set')
+        with self.lock:
+            if nx and self._live(key) is not None:
+                return None
+            self.values[key] = (value, time.monotonic() + px / 1000 if px else None)
+            return True
+
+    def delete(self, *keys):
+        record('cache.delete')
+        with self.lock:
+            return sum(1 for key in keys if self.values.pop(key, None) is not None)
+
+    def mget(self, keys):
+        record('cache.mget')
+        with self.lock:
+            return [entry[0] if entry else None for entry in map(self._live, keys)]
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def flushall(self):
+        with self.lock:
+            self.values.clear()
+
+    def close(self):
+        pass
+
+
+class MemoryPipeline:
+    """Queues SET commands and applies them as one round trip."""
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def set(self, key, value, px=None):
+        self.commands.append((key, value, px))
+
+    def execute(self):
+        record('cache.pipeline')
+        with self.client.lock:
+            for key, value, px in self.commands:
+                self.client.values[key] = (value, time.monotonic() + px / 1000 if px else None)
+        results, self.commands = [True] * len(self.commands), []
+        return results
+
+
+# Firebase auth
+
+TOKEN_LIFETIME = 3600
+
+
+def make_token(user_id, email):
+    """Build a token the memory verifier accepts for this user."""
+    return user_id + "|" + email
+
+
+class MemoryTokenVerifier:
+    """Accepts tokens built by make_token instead of Firebase-signed JWTs."""
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def warm(self):
+        pass
+
+    def verify(self, id_token):
+        try:
+            user_id, email = id_token.split("|", 1)
+        except ValueError:
+            raise ValueError("Invalid memory token")
+        return {"user_id": user_id, "email": email, "exp": time.time() + TOKEN_LIFETIME}
+
+
+# Shared instances, so the app and the code seeding it see the same data
+firestore_client = MemoryFirestore()
+storage_client = MemoryStorage()
+redis_client = MemoryRedis()
+token_verifier = MemoryTokenVerifier()
@@ -0,0 +1,97 @@
+import hashlib
+
+from fastapi.responses import HTMLResponse, Response
+
+from shared_cache import Cache
+
+# Rendered pages by ETag; the ETag covers everything the page was built from
+PAGE_TTL = 10 * 60
+
+pages = Cache('page', PAGE_TTL)
+
+# The last page rendered for each URL and client, served when a request is shed
+latest = Cache('page_latest', PAGE_TTL)
+
+# The data pages are built from (timelines, tweet and follow lists), keyed by
+# their own version stamps only. A page ETag also covers the username list and
+# templates, so a signup re-renders every page, but from this data.
+fragments = Cache('page_data', PAGE_TTL)
+
+
+def fallback_slot(request):
+    """Key for a shed request's stand-in page, or None for clients without one."""
+    client = getattr(request.state, 'client_key', None)
+    if client is None:
+        return None
+    return '{}?{}:{}'.format(request.url.path, request.url.query, client)
+
+
+def fallback(request):
+    """Return the last page rendered for this request's URL and client, or None."""
+    slot = fallback_slot(request)
+    if slot is None:
+        return None
+    found, body = latest.get(slot)
+    return body if found else None
+
+
+def page_etag(key, stamps):
+    """Return the ETag of a page built from key and version stamps."""
+    digest = hashlib.sha1(repr((key, stamps)).encode('utf-8')).hexdigest()[:24]
+    return '"{}"'.format(digest)
+
+
+def is_fresh(request, etag):
+    # Pages are validated by ETag only: a date can't tell apart two writes in one
+    # second, nor changes to the templates, username list or image URLs
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is None:
+        return False
+    return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+
+
+async def respond(request, key, stamps, render, run):
+    """Answer with 304, a cached page, or render(), depending on what the client and cache already have.
+
+    key holds everything besides the stamps that the page depends on (user,
+    cursors, template version). run calls the blocking cache off the event
+    loop, and render is awaited only when neither the client nor the cache
+    has this version of the page.
+    """
+    etag = page_etag(key, stamps)
+    headers = {
+        'ETag': etag,
+        # Pages are per user, and must be revalidated before they are reused
+        'Cache-Control': 'private, no-cache',
+        'Vary': 'Cookie',
+    }
+    if is_fresh(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    found, body = await run(pages.get, etag)
+    if found:
+        return HTMLResponse(body, headers=headers)
+
+    response = await render()
+    if response.status_code == 200:
+        await run(store, request, etag, response.body)
+        response.headers.update(headers)
+    return response
+
+
+async def fragment(key, stamps, load, run):
+    """Return await load(), or what it returned before for the same key and stamps."""
+    tag = page_etag(key, stamps)
+    found, data = await run(fragments.get, tag)
+    if found:
+        return data
+    data = await load()
+    await run(fragments.set, tag, data)
+    return data
+
+
+def store(request, etag, body):
+    pages.set(etag, body)
+    slot = fallback_slot(request)
+    if slot is not None:
+        latest.set(slot, body)
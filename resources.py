@@ -0,0 +1,86 @@
+import hashlib
+
+from fastapi.templating import Jinja2Templates
+from google.auth.transport import requests
+
+import admission
+import backends
+import data_access
+import instrumentation
+import live_updates
+import media_urls
+import shared_cache
+import username_directory
+
+
+class Resources:
+    """The clients one app shares between all of its requests.
+
+    Each app keeps its own on app.state.resources, so two apps in one
+    process never share clients, caches or limits. Opened and warmed by the
+    app's lifespan before the first request is served, and closed when the
+    worker shuts down. Connection pools are sized
+    for the data access pool, the most threads that use them at once.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.session = None
+        self.token_verifier = None
+        self.firestore = None
+        self.storage = None
+        self.media = None
+        self.templates = None
+        self.username_dir = None
+        self.timeline_feed = None
+        self.templates_version = None
+        self.cache = None
+        self.rate_limiter = None
+        self.limiter = None
+
+    def open(self):
+        if not self.settings.bucket:
+            raise RuntimeError("No storage bucket configured; set TWITTER_BUCKET")
+        pool_size = data_access.MAX_WORKERS
+        self.session = backends.http_session(pool_size)
+        self.cache = backends.cache_backend(self.settings.cache_url)
+        self.token_verifier = backends.token_verifier(requests.Request(self.session))
+        self.firestore = instrumentation.instrument_firestore(backends.firestore_client(self.settings.firestore_project))
+        self.storage = instrumentation.instrument_storage(backends.storage_client(self.settings.project, pool_size))
+        self.media = media_urls.MediaUrls(self.storage, self.settings.bucket)
+        self.templates = Jinja2Templates(directory=self.settings.templates_dir)
+        self.templates.TemplateResponse = instrumentation.time_templates(self.templates.TemplateResponse)
+        self.username_dir = username_directory.UsernameDirectory(self.firestore.collection('twitter_user'))
+        self.timeline_feed = live_updates.ChangeFeed(self.firestore)
+        self.rate_limiter = admission.RateLimiter(self.settings.rate_limit, self.settings.rate_burst)
+        self.limiter = admission.ConcurrencyLimiter(self.settings.max_in_flight or pool_size, self.settings.admission_wait)
+        return self
+
+    def warm(self):
+        """Do the slow first-use work now instead of in the first requests."""
+        self.token_verifier.warm()
+        self.token_verifier.start()
+        self.username_dir.start()
+        digest = hashlib.sha1()
+        for name in self.templates.env.list_templates():
+            self.templates.get_template(name)
+            source, _, _ = self.templates.env.loader.get_source(self.templates.env, name)
+            digest.update(name.encode('utf-8') + source.encode('utf-8'))
+        # Part of every page ETag, so a deploy with new templates never serves old pages
+        self.templates_version = digest.hexdigest()[:12]
+
+    def use(self):
+        """Point the caches of the current context at this worker's; returns a token for reset()."""
+        return shared_cache.use(self.cache)
+
+    def reset(self, token):
+        shared_cache.reset(token)
+
+    def close(self):
+        self.timeline_feed.stop()
+        self.username_dir.stop()
+        self.token_verifier.stop()
+        self.firestore.close()
+        self.storage.close()
+        self.session.close()
+        self.cache.close()
@@ -0,0 +1,215 @@
+import contextvars
+import copy
+import pickle
+import threading
+import time
+
+from metrics import registry
+from ttl_cache import TTLCache
+
+# How long a worker waits for another worker that is already loading a key
+LOAD_WAIT = 1.0
+LOAD_POLL_INTERVAL = 0.05
+
+cache_requests = registry.counter("cache_requests_total", "Shared cache lookups", ("cache", "result"))
+
+
+class LocalBackend:
+    """Process-local backend: one TTL+LRU map per worker.
+
+    Like a shared backend it hands out copies, so callers can change what
+    they get without changing the cached value.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.entries = TTLCache(ttl=0, maxsize=maxsize)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return copy.deepcopy(self.entries.get(key))
+
+    def set(self, key, value, ttl):
+        self.entries.set(key, copy.deepcopy(value), ttl=ttl)
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set_many(self, items, ttl):
+        for key, value in items.items():
+            self.set(key, value, ttl)
+
+    def add(self, key, value, ttl):
+        with self.lock:
+            if self.entries.get(key) is not None:
+                return False
+            self.entries.set(key, value, ttl=ttl)
+            return True
+
+    def delete(self, *keys):
+        for key in keys:
+            self.entries.invalidate(key)
+
+    def close(self):
+        self.entries.clear()
+
+
+class RedisBackend:
+    """Backend shared by every worker, on a Redis client or memory_backend's stand-in.
+
+    Entries expire with the key's TTL; set the server's maxmemory-policy to
+    allkeys-lru so the least recently used keys are evicted when it is full.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key):
+        raw = self.client.get(key)
+        return pickle.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(key, pickle.dumps(value), px=int(ttl * 1000))
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return [pickle.loads(raw) if raw is not None else None for raw in self.client.mget(keys)]
+
+    def set_many(self, items, ttl):
+        # One round trip for all of them
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in items.items():
+            pipeline.set(key, pickle.dumps(value), px=int(ttl * 1000))
+        pipeline.execute()
+
+    def add(self, key, value, ttl):
+        return bool(self.client.set(key, pickle.dumps(value), px=int(ttl * 1000), nx=True))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*keys)
+
+    def close(self):
+        self.client.close()
+
+
+# Used outside of any app's requests, e.g. by scripts and tests
+default_backend = LocalBackend()
+
+# The backend of the app whose request is being served; each app owns its own
+_current = contextvars.ContextVar('shared_cache_backend', default=None)
+
+
+def use(new_backend):
+    """Point every Cache at new_backend in the current context; returns a token for reset()."""
+    return _current.set(new_backend)
+
+
+def reset(token):
+    _current.reset(token)
+
+
+def current_backend():
+    return _current.get() or default_backend
+
+
+class _Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class Cache:
+    """A namespace of cached values with a TTL, on the current app's backend; see use().
+
+    get_or_load coalesces concurrent misses: within a worker only one thread
+    runs the loader per key, and across workers the first to claim the key
+    loads it while the others wait briefly for its result. Writers call
+    invalidate after changing the underlying data.
+    """
+
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def key(self, key):
+        return "{}:{}".format(self.name, key)
+
+    def get(self, key):
+        """Return (found, value); value may itself be None."""
+        entry = current_backend().get(self.key(key))
+        if entry is None:
+            return False, None
+        return True, entry[0]
+
+    def set(self, key, value, ttl=None):
+        # Wrapped so that a cached None is told apart from a miss
+        current_backend().set(self.key(key), (value,), self.ttl if ttl is None else ttl)
+
+    def get_many(self, keys):
+        """Return {key: value} for the keys that are cached."""
+        entries = current_backend().get_many([self.key(key) for key in keys])
+        return {key: entry[0] for key, entry in zip(keys, entries) if entry is not None}
+
+    def set_many(self, items, ttl=None):
+        if items:
+            current_backend().set_many({self.key(key): (value,) for key, value in items.items()}, self.ttl if ttl is None else ttl)
+
+    def invalidate(self, *keys):
+        current_backend().delete(*[self.key(key) for key in keys])
+
+    def get_or_load(self, key, loader):
+        found, value = self.get(key)
+        if found:
+            cache_requests.inc(cache=self.name, result="hit")
+            return value
+
+        # Loads are only shared between requests of the same app
+        flight_key = (id(current_backend()), key)
+        with self.lock:
+            flight = self.flights.get(flight_key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[flight_key] = _Flight()
+        if not leader:
+            cache_requests.inc(cache=self.name, result="coalesced")
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        cache_requests.inc(cache=self.name, result="miss")
+        try:
+            flight.value = self._load_shared(key, loader)
+            return flight.value
+        except Exception as err:
+            flight.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.flights[flight_key]
+            flight.done.set()
+
+    def _load_shared(self, key, loader):
+        lock_key = self.key(key) + ":loading"
+        backend = current_backend()
+        claimed = backend.add(lock_key, True, LOAD_WAIT)
+        if not claimed:
+            # Another worker is loading it; use its result if it arrives in time
+            deadline = time.monotonic() + LOAD_WAIT
+            while time.monotonic() < deadline:
+                time.sleep(LOAD_POLL_INTERVAL)
+                found, value = self.get(key)
+                if found:
+                    return value
+        try:
+            value = loader()
+            self.set(key, value)
+            return value
+        finally:
+            if claimed:
+                backend.delete(lock_key)
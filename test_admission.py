@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+import admission
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission.time, 'monotonic', clock)
+    return clock
+
+
+def test_rate_limiter_allows_a_burst_then_refills_at_the_rate(clock):
+    limiter = admission.RateLimiter(rate=2, burst=3)
+    for _ in range(3):
+        limiter.check('home', 'alice')
+    with pytest.raises(admission.RateLimited) as raised:
+        limiter.check('home', 'alice')
+    assert raised.value.status_code == 429
+    assert raised.value.retry_after == 1
+
+    clock.now += 0.5
+    limiter.check('home', 'alice')
+    with pytest.raises(admission.RateLimited):
+        limiter.check('home', 'alice')
+
+
+def test_rate_limiter_keeps_a_bucket_per_route_and_client(clock):
+    limiter = admission.RateLimiter(rate=1, burst=1)
+    limiter.check('home', 'alice')
+    limiter.check('home', 'bob')
+    limiter.check('search', 'alice')
+    with pytest.raises(admission.RateLimited):
+        limiter.check('home', 'alice')
+
+
+def test_rate_limiter_with_no_rate_admits_everything(clock):
+    limiter = admission.RateLimiter(rate=0, burst=0)
+    for _ in range(100):
+        limiter.check('home', 'alice')
+
+
+def test_concurrency_limiter_sheds_past_the_limit_until_a_slot_is_released():
+    async def scenario():
+        limiter = admission.ConcurrencyLimiter(limit=2, wait=0.01)
+        await limiter.acquire()
+        await limiter.acquire()
+        with pytest.raises(admission.Overloaded) as raised:
+            await limiter.acquire()
+        assert raised.value.status_code == 503
+
+        limiter.release()
+        await limiter.acquire()
+        limiter.release()
+        limiter.release()
+        return limiter.semaphore._value
+
+    assert asyncio.run(scenario()) == 2
+
+
+def test_concurrency_limiter_admits_a_waiter_released_within_the_wait():
+    async def scenario():
+        limiter = admission.ConcurrencyLimiter(limit=1, wait=1.0)
+        await limiter.acquire()
+        asyncio.get_running_loop().call_later(0.01, limiter.release)
+        await limiter.acquire()
+        limiter.release()
+
+    asyncio.run(scenario())
@@ -0,0 +1,107 @@
+import functools
+from datetime import datetime, timedelta
+
+import pytest
+
+import bulk_io
+import follow_graph
+import memory_backend
+import timeline_store
+import tweet_search
+
+
+def populate(db, users=5, tweets=3):
+    start = datetime(2024, 5, 17)
+    for index in range(users):
+        user_id = 'user{}'.format(index)
+        db.collection('twitter_user').document(user_id).set({
+            'username': user_id, 'follower_count': 0, 'following_count': 0, 'timeline_ready': True,
+        })
+        for number in range(tweets):
+            timeline_store.tweets_ref(db, user_id).document('{}-t{}'.format(user_id, number)).set({
+                'tweetText': 'tweet {} by {}'.format(number, user_id), 'date': start + timedelta(hours=number),
+            })
+    for index in range(users):
+        follow_graph.follow(db, 'user{}'.format(index), 'user{}'.format((index + 1) % users))
+
+
+def documents(db):
+    """Every document under twitter_user, by path; timelines are not archived."""
+    return {parent + '/' + document_id: data
+            for parent, collection in db._collections.items() if parent.split('/')[-1] != 'timeline'
+            for document_id, data in collection.items()}
+
+
+def test_a_round_trip_keeps_users_tweets_and_follow_edges(tmp_path):
+    source = memory_backend.MemoryFirestore()
+    populate(source)
+    archive = str(tmp_path / 'archive.ndjson')
+    assert bulk_io.export(source, archive) == 5 + 5 * 3 + 5 * 2
+
+    target = memory_backend.MemoryFirestore()
+    assert bulk_io.import_(target, archive) == (30, [])
+
+    imported = documents(target)
+    assert imported.keys() == documents(source).keys()
+    assert 'timeline_ready' not in imported['twitter_user/user0']
+    assert imported['twitter_user/user0']['follower_count'] == 1
+    assert imported['twitter_user/user0/tweets/user0-t1']['search_terms'] == tweet_search.terms('tweet 1 by user0')
+    assert follow_graph.follower_ids(target, 'user1') == ['user0']
+
+
+def test_an_interrupted_export_resumes_from_its_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(bulk_io, 'pages', functools.partial(bulk_io.pages, page_size=2))
+    db = memory_backend.MemoryFirestore()
+    populate(db)
+    expected = str(tmp_path / 'expected.ndjson')
+    bulk_io.export(db, expected)
+
+    archive, checkpoint = str(tmp_path / 'archive.ndjson'), str(tmp_path / 'export.json')
+    dumps = bulk_io.dumps
+
+    def crash_in_the_second_page(path, data):
+        # user2 is in the second page of users, after some of its lines were written
+        if path == 'twitter_user/user2/tweets/user2-t1':
+            raise RuntimeError("interrupted")
+        return dumps(path, data)
+
+    monkeypatch.setattr(bulk_io, 'dumps', crash_in_the_second_page)
+    with pytest.raises(RuntimeError):
+        bulk_io.export(db, archive, checkpoint)
+    assert bulk_io.read_checkpoint(checkpoint)['after'] == 'user1'
+
+    monkeypatch.setattr(bulk_io, 'dumps', dumps)
+    assert bulk_io.export(db, archive, checkpoint) == 30
+    with open(archive) as resumed, open(expected) as complete:
+        assert resumed.read() == complete.read()
+
+
+def test_an_interrupted_import_resumes_from_its_checkpoint(tmp_path, monkeypatch):
+    source = memory_backend.MemoryFirestore()
+    populate(source)
+    archive, checkpoint = str(tmp_path / 'archive.ndjson'), str(tmp_path / 'import.json')
+    bulk_io.export(source, archive)
+
+    target = memory_backend.MemoryFirestore()
+    prepare = bulk_io.prepare
+
+    def crash_after_two_flushes(path, data):
+        if path == 'twitter_user/user2':
+            raise RuntimeError("interrupted")
+        return prepare(path, data)
+
+    monkeypatch.setattr(bulk_io, 'prepare', crash_after_two_flushes)
+    with pytest.raises(RuntimeError):
+        bulk_io.import_(target, archive, checkpoint, flush_every=5)
+    assert bulk_io.read_checkpoint(checkpoint)['documents'] == 10
+
+    monkeypatch.setattr(bulk_io, 'prepare', prepare)
+    assert bulk_io.import_(target, archive, checkpoint, flush_every=5) == (30, [])
+    assert documents(target).keys() == documents(source).keys()
+
+
+def test_prepare_rejects_paths_outside_the_archive_layout():
+    with pytest.raises(ValueError):
+        bulk_io.prepare('twitter_user/user0/timeline/t1', {})
+    with pytest.raises(ValueError):
+        bulk_io.prepare('trending/top', {})
@@ -0,0 +1,51 @@
+import base64
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import cursors
+import memory_backend
+
+
+def raw_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode('utf-8')).decode('ascii')
+
+
+def test_decode_returns_what_encode_was_given():
+    date = datetime(2024, 5, 17, 8, 30, 15, 123456)
+    assert cursors.decode(cursors.encode(date, 'twitter_user/alice/tweets/t1')) == (date, 'twitter_user/alice/tweets/t1')
+
+
+@pytest.mark.parametrize('cursor', [
+    '',
+    'not a cursor!',
+    'é',
+    base64.urlsafe_b64encode(b'\xff\xfe').decode('ascii'),
+    raw_cursor({'date': '2024-05-17', 'key': 't1'}),
+    raw_cursor(['2024-05-17T08:30:15']),
+    raw_cursor(['yesterday', 't1']),
+    raw_cursor([None, 't1']),
+])
+def test_decode_rejects_malformed_cursors_with_value_error(cursor):
+    with pytest.raises(ValueError):
+        cursors.decode(cursor)
+
+
+def test_newest_first_pages_through_tweets_with_the_same_date():
+    db = memory_backend.MemoryFirestore()
+    tweets = db.collection('twitter_user').document('alice').collection('tweets')
+    start = datetime(2024, 5, 17)
+    # Pairs of tweets share a date, so the document ID has to break the tie
+    for number in range(7):
+        tweets.document('t{}'.format(number)).set({'date': start + timedelta(minutes=number // 2)})
+
+    seen, cursor = [], None
+    while True:
+        page = list(cursors.newest_first(tweets, 3, cursor, tweets.document).stream())
+        seen.extend(doc.id for doc in page)
+        if len(page) < 3:
+            break
+        cursor = cursors.encode(page[-1].get('date'), page[-1].id)
+
+    assert seen == ['t6', 't5', 't4', 't3', 't2', 't1', 't0']
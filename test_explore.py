@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import explore
+import memory_backend
+import shared_cache
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    monkeypatch.setattr(shared_cache, 'default_backend', shared_cache.LocalBackend())
+
+
+def totals(db):
+    counts = {}
+    for bucket in explore.buckets_ref(db).stream():
+        for term, count in bucket.to_dict().get('counts', {}).items():
+            counts[term] = counts.get(term, 0) + count
+    return {term: count for term, count in counts.items() if count}
+
+
+def test_trending_terms_count_hashtags_and_words_once():
+    assert explore.trending_terms("Deploy #Launch the launch of 2024 deploy, ok") == {'#launch', 'deploy', 'launch'}
+
+
+def test_edits_and_deletes_move_the_counts():
+    db = memory_backend.MemoryFirestore()
+    now = datetime.utcnow()
+    explore.count_tweet(db, "coffee and music #weekend", now)
+    explore.count_tweet(db, "coffee again", now)
+    assert totals(db) == {'coffee': 2, 'music': 1, '#weekend': 1, 'again': 1}
+
+    explore.recount_tweet(db, "coffee and music #weekend", "coffee and travel", now)
+    assert totals(db) == {'coffee': 2, 'travel': 1, 'again': 1}
+
+    explore.count_tweet(db, "coffee again", now, -1)
+    assert totals(db) == {'coffee': 1, 'travel': 1}
+
+
+def test_tweets_older_than_the_window_are_not_counted():
+    db = memory_backend.MemoryFirestore()
+    explore.count_tweet(db, "coffee", datetime.utcnow() - explore.WINDOW - explore.BUCKET_SIZE)
+    assert totals(db) == {}
+
+
+def test_compute_top_sums_the_buckets_in_the_window():
+    db = memory_backend.MemoryFirestore()
+    now = datetime.utcnow()
+    for _ in range(3):
+        explore.count_tweet(db, "coffee", now)
+    explore.count_tweet(db, "music coffee", now - timedelta(hours=2))
+    explore.count_tweet(db, "travel", now)
+    explore.count_tweet(db, "travel", now, -1)
+
+    top = explore.compute_top(db)
+    assert top['terms'] == [{'term': 'coffee', 'count': 4}, {'term': 'music', 'count': 1}]
+    assert db.collection('trending').document('top').get().to_dict()['terms'] == top['terms']
+
+
+def test_trending_recomputes_a_stale_top_list():
+    db = memory_backend.MemoryFirestore()
+    explore.count_tweet(db, "coffee", datetime.utcnow())
+    db.collection('trending').document('top').set({
+        'terms': [{'term': 'stale', 'count': 9}],
+        'computed_at': datetime.utcnow() - explore.REFRESH_INTERVAL,
+    })
+    assert explore.trending(db) == [{'term': 'coffee', 'count': 1}]
+
+
+def test_trending_reuses_a_fresh_top_list():
+    db = memory_backend.MemoryFirestore()
+    explore.count_tweet(db, "coffee", datetime.utcnow())
+    fresh = [{'term': 'music', 'count': 3}]
+    db.collection('trending').document('top').set({'terms': fresh, 'computed_at': datetime.utcnow()})
+    assert explore.trending(db) == fresh
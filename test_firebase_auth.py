@@ -0,0 +1,101 @@
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import firebase_auth
+
+
+class CertsEndpoint:
+    """Stands in for the transport request; serves the current key set and counts fetches."""
+
+    def __init__(self, *key_ids, max_age=600):
+        self.certs = {key_id: 'cert-' + key_id for key_id in key_ids}
+        self.max_age = max_age
+        self.fetches = 0
+
+    def __call__(self, url, method="GET"):
+        self.fetches += 1
+        return SimpleNamespace(status=200, headers={'cache-control': 'public, max-age={}'.format(self.max_age)},
+                               data=json.dumps(self.certs).encode('utf-8'))
+
+
+@pytest.fixture
+def decodes(monkeypatch):
+    """Replace signature checks with a lookup of the token's key id, 'kid.user', and count them."""
+    calls = []
+
+    def decode(token, certs, audience=None):
+        calls.append(token)
+        key_id, user_id = token.split('.')
+        if key_id not in certs:
+            raise ValueError("Certificate for key id {} not found.".format(key_id))
+        return {'user_id': user_id, 'exp': time.time() + 3600}
+
+    monkeypatch.setattr(firebase_auth.jwt, 'decode', decode)
+    return calls
+
+
+def test_verified_tokens_are_served_from_the_cache(decodes):
+    endpoint = CertsEndpoint('k1')
+    verifier = firebase_auth.TokenVerifier(endpoint)
+
+    assert verifier.verify('k1.alice')['user_id'] == 'alice'
+    assert verifier.verify('k1.alice')['user_id'] == 'alice'
+
+    assert decodes == ['k1.alice']
+    assert endpoint.fetches == 1
+    assert verifier.certs_expiry == pytest.approx(time.time() + 600, abs=5)
+
+
+def test_expired_and_least_recently_used_tokens_are_dropped(decodes):
+    verifier = firebase_auth.TokenVerifier(CertsEndpoint('k1'), cache_size=2)
+    for user_id in ('alice', 'bob'):
+        verifier.verify('k1.' + user_id)
+    verifier.verify('k1.alice')
+    verifier.verify('k1.carol')
+    assert list(verifier.tokens) == ['k1.alice', 'k1.carol']
+
+    verifier.tokens['k1.alice']['exp'] = time.time() - 1
+    verifier.verify('k1.alice')
+    assert decodes.count('k1.alice') == 2
+
+
+def test_a_rotated_in_key_is_fetched_once_out_of_schedule(decodes):
+    endpoint = CertsEndpoint('k1')
+    verifier = firebase_auth.TokenVerifier(endpoint)
+    verifier.verify('k1.alice')
+
+    endpoint.certs['k2'] = 'cert-k2'
+    assert verifier.verify('k2.bob')['user_id'] == 'bob'
+    assert endpoint.fetches == 2
+
+
+def test_unknown_key_ids_refetch_at_most_once_per_interval(decodes):
+    endpoint = CertsEndpoint('k1')
+    verifier = firebase_auth.TokenVerifier(endpoint)
+    verifier.verify('k1.alice')
+
+    for forged in ('x1.mallory', 'x2.mallory', 'x3.mallory'):
+        with pytest.raises(ValueError):
+            verifier.verify(forged)
+    assert endpoint.fetches == 2
+
+    verifier.last_forced_refresh -= firebase_auth.FORCED_REFRESH_INTERVAL
+    with pytest.raises(ValueError):
+        verifier.verify('x4.mallory')
+    assert endpoint.fetches == 3
+
+
+def test_other_decode_errors_do_not_refetch(monkeypatch):
+    endpoint = CertsEndpoint('k1')
+    verifier = firebase_auth.TokenVerifier(endpoint)
+
+    def expired(token, certs, audience=None):
+        raise ValueError("Token expired")
+
+    monkeypatch.setattr(firebase_auth.jwt, 'decode', expired)
+    with pytest.raises(ValueError):
+        verifier.verify('k1.alice')
+    assert endpoint.fetches == 1
@@ -0,0 +1,95 @@
+import threading
+import time
+
+import pytest
+
+import shared_cache
+
+
+@pytest.fixture(autouse=True)
+def backend(monkeypatch):
+    backend = shared_cache.LocalBackend()
+    monkeypatch.setattr(shared_cache, 'default_backend', backend)
+    return backend
+
+
+def load_concurrently(cache, key, loader, threads=8):
+    results, errors = [], []
+
+    def run():
+        try:
+            results.append(cache.get_or_load(key, loader))
+        except Exception as err:
+            errors.append(err)
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results, errors
+
+
+def test_concurrent_misses_run_the_loader_once():
+    cache = shared_cache.Cache('users', 60)
+    calls = []
+
+    def loader():
+        calls.append(1)
+        time.sleep(0.05)
+        return {'username': 'alice'}
+
+    results, errors = load_concurrently(cache, 'alice', loader)
+    assert errors == []
+    assert results == [{'username': 'alice'}] * 8
+    assert len(calls) == 1
+    assert cache.get('alice') == (True, {'username': 'alice'})
+
+
+def test_a_failed_load_reaches_every_waiter_and_is_not_cached():
+    cache = shared_cache.Cache('users', 60)
+
+    def loader():
+        time.sleep(0.05)
+        raise RuntimeError("Firestore unavailable")
+
+    results, errors = load_concurrently(cache, 'alice', loader)
+    assert results == []
+    assert len(errors) == 8 and all(isinstance(err, RuntimeError) for err in errors)
+    assert cache.get('alice') == (False, None)
+    assert cache.get_or_load('alice', lambda: 'loaded') == 'loaded'
+
+
+def test_none_is_cached_like_any_other_value():
+    cache = shared_cache.Cache('users', 60)
+    calls = []
+    for _ in range(2):
+        assert cache.get_or_load('nobody', lambda: calls.append(1)) is None
+    assert len(calls) == 1
+
+
+def test_a_key_another_worker_is_loading_waits_for_its_result(backend, monkeypatch):
+    monkeypatch.setattr(shared_cache, 'LOAD_WAIT', 0.5)
+    cache = shared_cache.Cache('users', 60)
+    # Another worker claimed the key and stores its result shortly after
+    backend.add(cache.key('alice') + ':loading', True, 1)
+    threading.Timer(0.05, cache.set, ('alice', 'from the other worker')).start()
+
+    assert cache.get_or_load('alice', lambda: 'loaded here') == 'from the other worker'
+
+
+def test_a_worker_that_never_finishes_loading_is_waited_for_briefly(backend, monkeypatch):
+    monkeypatch.setattr(shared_cache, 'LOAD_WAIT', 0.1)
+    cache = shared_cache.Cache('users', 60)
+    backend.add(cache.key('alice') + ':loading', True, 1)
+
+    started = time.monotonic()
+    assert cache.get_or_load('alice', lambda: 'loaded here') == 'loaded here'
+    assert time.monotonic() - started >= 0.1
+
+
+def test_invalidate_makes_the_next_read_load_again():
+    cache = shared_cache.Cache('users', 60)
+    cache.get_or_load('alice', lambda: 1)
+    cache.invalidate('alice')
+    assert cache.get_or_load('alice', lambda: 2) == 2
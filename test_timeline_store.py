@@ -0,0 +1,81 @@
+from datetime import datetime
+
+import follow_graph
+import memory_backend
+import timeline_store
+
+
+def make_user(db, user_id):
+    db.collection('twitter_user').document(user_id).set({
+        'username': user_id, 'follower_count': 0, 'following_count': 0, 'timeline_ready': True,
+    })
+
+
+def user_data(db, user_id):
+    return db.collection('twitter_user').document(user_id).get().to_dict()
+
+
+def timeline_texts(db, user_id):
+    timeline, _ = timeline_store.read_timeline(db, user_id, user_data(db, user_id))
+    return [tweet['tweetText'] for tweet in timeline]
+
+
+def test_retract_reaches_followers_from_before_the_author_grew(monkeypatch):
+    monkeypatch.setattr(timeline_store, 'FANOUT_FOLLOWER_LIMIT', 1)
+    db = memory_backend.MemoryFirestore()
+    for user_id in ('alice', 'bob', 'carol'):
+        make_user(db, user_id)
+
+    follow_graph.follow(db, 'bob', 'alice')
+    tweet_ref = timeline_store.tweets_ref(db, 'alice').document()
+    tweet = {'tweetText': 'hello world', 'username': 'alice', 'date': datetime.utcnow()}
+    tweet_ref.set(tweet)
+    timeline_store.push_tweet(db, 'alice', user_data(db, 'alice'), tweet_ref.id, tweet)
+    assert timeline_texts(db, 'bob') == ['hello world']
+
+    # A second follower takes alice past the fan-out limit
+    follow_graph.follow(db, 'carol', 'alice')
+    timeline_store.large_authors_cache.invalidate('bob', 'carol')
+    tweet_ref.delete()
+    timeline_store.retract_tweet(db, 'alice', user_data(db, 'alice'), tweet_ref.id)
+
+    assert timeline_texts(db, 'alice') == []
+    assert timeline_texts(db, 'bob') == []
+
+
+def test_revise_leaves_timelines_without_the_tweet_alone():
+    db = memory_backend.MemoryFirestore()
+    for user_id in ('alice', 'bob', 'carol'):
+        make_user(db, user_id)
+    follow_graph.follow(db, 'bob', 'alice')
+    tweet_ref = timeline_store.tweets_ref(db, 'alice').document()
+    tweet = {'tweetText': 'hello world', 'username': 'alice', 'date': datetime.utcnow()}
+    tweet_ref.set(tweet)
+    timeline_store.push_tweet(db, 'alice', user_data(db, 'alice'), tweet_ref.id, tweet)
+
+    # carol follows after the tweet was pushed, so her timeline never had it
+    follow_graph.follow(db, 'carol', 'alice')
+    timeline_store.revise_tweet(db, 'alice', user_data(db, 'alice'), tweet_ref.id, {'tweetText': 'hello again'})
+
+    assert timeline_texts(db, 'bob') == ['hello again']
+    assert not timeline_store.timeline_ref(db, 'carol').document(tweet_ref.id).get().exists
+
+
+def test_follower_past_the_limit_sees_the_author_merged_in(monkeypatch):
+    monkeypatch.setattr(timeline_store, 'FANOUT_FOLLOWER_LIMIT', 1)
+    db = memory_backend.MemoryFirestore()
+    for user_id in ('alice', 'bob', 'carol'):
+        make_user(db, user_id)
+
+    timeline_store.follow_author(db, 'bob', 'alice', user_data(db, 'alice'))
+    tweet_ref = timeline_store.tweets_ref(db, 'alice').document()
+    tweet = {'tweetText': 'hello', 'username': 'alice', 'date': datetime.utcnow()}
+    tweet_ref.set(tweet)
+    timeline_store.push_tweet(db, 'alice', user_data(db, 'alice'), tweet_ref.id, tweet)
+
+    # carol's follow takes alice past the limit, so alice is merged on read instead of backfilled
+    timeline_store.follow_author(db, 'carol', 'alice', user_data(db, 'alice'))
+    assert user_data(db, 'alice')['fanout'] is False
+    timeline_store.large_authors_cache.invalidate('bob', 'carol')
+    assert timeline_texts(db, 'carol') == ['hello']
+    assert timeline_texts(db, 'bob') == ['hello']
@@ -0,0 +1,256 @@
+from datetime import datetime, timedelta
+
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+import cursors
+import follow_graph
+import tweet_search
+import versions
+from shared_cache import Cache
+
+# Number of tweets shown on the home page
+TIMELINE_LENGTH = 20
+
+# Authors with more followers than this are not fanned out on write.
+# Their followers merge the author's recent tweets in when reading instead.
+FANOUT_FOLLOWER_LIMIT = 1000
+
+# Firestore allows at most 500 writes in one batch
+BATCH_SIZE = 500
+
+# Retracted entries are kept this long as tombstones so live streams see the removal.
+# A Firestore TTL policy on the 'timeline' collection group's 'expire_at' field deletes them.
+TOMBSTONE_TTL = timedelta(days=1)
+
+# Seconds a user's list of followed large authors is reused. Follows and
+# unfollows invalidate it; an author crossing FANOUT_FOLLOWER_LIMIT shows up
+# within this time.
+LARGE_AUTHORS_TTL = 60
+
+large_authors_cache = Cache('large_authors', LARGE_AUTHORS_TTL)
+
+
+def timeline_ref(db, user_id):
+    return db.collection('twitter_user').document(user_id).collection('timeline')
+
+
+def tweets_ref(db, user_id):
+    return db.collection('twitter_user').document(user_id).collection('tweets')
+
+
+def is_fanout_author(author_data):
+    return follow_graph.follower_count(author_data) <= FANOUT_FOLLOWER_LIMIT
+
+
+def timeline_entry(author_id, tweet_id, tweet_data):
+    entry = dict(tweet_data)
+    entry.pop(tweet_search.TERMS_FIELD, None)
+    entry['tweetID'] = tweet_id
+    entry['userID'] = author_id
+    return entry
+
+
+def tombstone(author_id, tweet_id):
+    # No 'date' field, so the date-ordered timeline queries never return it
+    now = datetime.utcnow()
+    return {'tweetID': tweet_id, 'userID': author_id, 'deleted': True, 'updated': now, 'expire_at': now + TOMBSTONE_TTL}
+
+
+def recent_tweets(db, author_id, limit=TIMELINE_LENGTH, cursor=None):
+    ref = tweets_ref(db, author_id)
+    query = cursors.newest_first(ref, limit, cursor, ref.document)
+    return [timeline_entry(author_id, doc.id, doc.to_dict()) for doc in query.stream()]
+
+
+def commit_in_batches(db, operations):
+    """Apply (method, ref, data) operations using as few batched writes as possible.
+
+    method is a WriteBatch method name, or 'merge' for a set with merge=True.
+    """
+    batch = db.batch()
+    count = 0
+    for method, ref, data in operations:
+        if method == 'delete':
+            batch.delete(ref)
+        elif method == 'merge':
+            batch.set(ref, data, merge=True)
+        else:
+            getattr(batch, method)(ref, data)
+        count += 1
+        if count == BATCH_SIZE:
+            batch.commit()
+            batch = db.batch()
+            count = 0
+    if count:
+        batch.commit()
+
+
+def fanout_targets(db, author_id, author_data):
+    # The author always sees their own tweets; followers only when the author is small enough
+    targets = [author_id]
+    if is_fanout_author(author_data):
+        targets.extend(follow_graph.follower_ids(db, author_id))
+    return targets
+
+
+def sync_fanout_flag(db, author_id, author_data):
+    # Readers use this flag to find the high-follower authors they must merge on read
+    fanout = is_fanout_author(author_data)
+    if author_data.get('fanout', True) != fanout:
+        db.collection('twitter_user').document(author_id).update({'fanout': fanout})
+        author_data['fanout'] = fanout
+
+
+def tweet_entries(db, tweet_id):
+    """Return the timeline entries that hold a tweet, wherever it was pushed or backfilled.
+
+    Needs the collection group index on 'timeline' for 'tweetID'.
+    """
+    query = db.collection_group('timeline').where(filter=FieldFilter('tweetID', '==', tweet_id)).select(['__name__'])
+    return [doc.reference for doc in query.stream()]
+
+
+def push_tweet(db, author_id, author_data, tweet_id, tweet_data):
+    """Write a new tweet into the timelines of its author and followers."""
+    sync_fanout_flag(db, author_id, author_data)
+    entry = timeline_entry(author_id, tweet_id, tweet_data)
+    # Live update streams follow timeline entries by when they were last written
+    entry['updated'] = datetime.utcnow()
+    targets = fanout_targets(db, author_id, author_data)
+    commit_in_batches(db, [('set', timeline_ref(db, target).document(tweet_id), entry) for target in targets])
+    # Cached pages built from these timelines are now stale; the caller bumps the author's tweets
+    versions.bump('timeline', *targets)
+
+
+def revise_tweet(db, author_id, author_data, tweet_id, changes):
+    """Apply an edit to the timeline entries that hold a tweet, without reading the tweet."""
+    entry = timeline_entry(author_id, tweet_id, changes)
+    entry['updated'] = datetime.utcnow()
+    refs = tweet_entries(db, tweet_id)
+    try:
+        commit_in_batches(db, [('update', ref, entry) for ref in refs])
+    except NotFound:
+        # An entry went away after it was found (an unfollow); batches are all or
+        # nothing, so apply the edit to each entry on its own, skipping the gone ones
+        for ref in refs:
+            try:
+                ref.update(entry)
+            except NotFound:
+                pass
+    versions.bump('timeline', *[ref.parent.parent.id for ref in refs])
+
+
+def retract_tweet(db, author_id, author_data, tweet_id):
+    """Remove a deleted tweet from every timeline that holds it.
+
+    The current followers are not enough: an author who has grown past
+    FANOUT_FOLLOWER_LIMIT fans out to nobody, yet earlier followers still
+    have the tweet.
+    """
+    refs = tweet_entries(db, tweet_id)
+    entry = tombstone(author_id, tweet_id)
+    commit_in_batches(db, [('set', ref, entry) for ref in refs])
+    versions.bump('timeline', *[ref.parent.parent.id for ref in refs])
+
+
+def follow_author(db, user_id, author_id, author_data):
+    """Follow author_id and copy their recent tweets into user_id's timeline; False if already following."""
+    if not follow_graph.follow(db, user_id, author_id):
+        return False
+    # The new follower can take the author past FANOUT_FOLLOWER_LIMIT, and readers
+    # only merge their tweets in once the flag says so
+    author_data['follower_count'] = follow_graph.follower_count(author_data) + 1
+    sync_fanout_flag(db, author_id, author_data)
+    backfill_author(db, user_id, author_id, author_data)
+    return True
+
+
+def unfollow_author(db, user_id, author_id, author_data):
+    """Unfollow author_id and drop their tweets from user_id's timeline; False if not following."""
+    if not follow_graph.unfollow(db, user_id, author_id):
+        return False
+    author_data['follower_count'] = follow_graph.follower_count(author_data) - 1
+    sync_fanout_flag(db, author_id, author_data)
+    remove_author(db, user_id, author_id)
+    return True
+
+
+def backfill_author(db, user_id, author_id, author_data):
+    """Copy an author's recent tweets into a new follower's timeline."""
+    if not is_fanout_author(author_data):
+        return
+    updated = datetime.utcnow()
+    operations = [('set', timeline_ref(db, user_id).document(tweet['tweetID']), dict(tweet, updated=updated))
+                  for tweet in recent_tweets(db, author_id)]
+    commit_in_batches(db, operations)
+    versions.bump('timeline', user_id)
+
+
+def remove_author(db, user_id, author_id):
+    """Drop an author's tweets from a former follower's timeline."""
+    entries = timeline_ref(db, user_id).where(filter=FieldFilter('userID', '==', author_id)).stream()
+    commit_in_batches(db, [('delete', doc.reference, None) for doc in entries])
+    versions.bump('timeline', user_id)
+
+
+def merge_timeline(db, user_id, user_data, limit=TIMELINE_LENGTH):
+    """Build a timeline by reading every followed author's tweets (the pre-materialized path)."""
+    all_tweets = recent_tweets(db, user_id, limit)
+    for following_id in follow_graph.following_ids(db, user_id):
+        all_tweets.extend(recent_tweets(db, following_id, limit))
+    all_tweets.sort(key=lambda x: x['date'], reverse=True)
+    return all_tweets[:limit]
+
+
+def backfill_timeline(db, user_id, user_data):
+    """Materialize the timeline of a user created before fan-out-on-write existed."""
+    timeline = merge_timeline(db, user_id, user_data)
+    operations = [('set', timeline_ref(db, user_id).document(tweet['tweetID']), tweet) for tweet in timeline]
+    operations.append(('update', db.collection('twitter_user').document(user_id), {'timeline_ready': True}))
+    commit_in_batches(db, operations)
+    versions.bump('timeline', user_id)
+    # The caller's copy may be cached, so record the flag there as well
+    user_data['timeline_ready'] = True
+    return timeline
+
+
+def large_followed_authors(db, user_id):
+    """Return the followed authors whose tweets are merged on read instead of fanned out."""
+    def load():
+        # Large authors are few, so find them all and keep the ones this user follows
+        large_authors = db.collection('twitter_user').where(filter=FieldFilter('fanout', '==', False)).select(['__name__']).stream()
+        return follow_graph.following_subset(db, user_id, [author.id for author in large_authors])
+    return large_authors_cache.get_or_load(user_id, load)
+
+
+def read_timeline(db, user_id, user_data, limit=TIMELINE_LENGTH, cursor=None):
+    """Return (tweets, next_cursor) for a page of a user's home timeline.
+
+    Reads the materialized timeline and merges in the recent tweets of any
+    followed authors that are too large to fan out on write. Every source is
+    read from the (date, tweetID) cursor onwards, so a page costs the same
+    whichever page it is.
+    """
+    if not user_data.get('timeline_ready'):
+        backfill_timeline(db, user_id, user_data)
+
+    ref = timeline_ref(db, user_id)
+    timeline = [doc.to_dict() for doc in cursors.newest_first(ref, limit, cursor, ref.document).stream()]
+    more = len(timeline) == limit
+
+    for author_id in large_followed_authors(db, user_id):
+        tweets = recent_tweets(db, author_id, limit, cursor)
+        more = more or len(tweets) == limit
+        timeline.extend(tweets)
+
+    # An author whose fan-out mode changed can appear both materialized and merged
+    timeline = list({tweet['tweetID']: tweet for tweet in timeline}.values())
+    timeline.sort(key=lambda x: (x['date'], x['tweetID']), reverse=True)
+    more = more or len(timeline) > limit
+    timeline = timeline[:limit]
+
+    next_cursor = None
+    if more and timeline:
+        next_cursor = cursors.encode(timeline[-1]['date'], timeline[-1]['tweetID'])
+    return timeline, next_cursor
@@ -0,0 +1,100 @@
+import re
+
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+import cursors
+
+# Every tweet stores its index terms in this array field. Firestore indexes
+# array members, so array_contains_any on it is an inverted index lookup.
+TERMS_FIELD = 'search_terms'
+
+# Also index the prefixes of each word so partial words match
+INDEX_PREFIXES = True
+MIN_PREFIX_LENGTH = 2
+
+# array_contains_any accepts at most 30 values
+MAX_QUERY_TERMS = 30
+
+# Results per page; each page costs this many document reads at most
+PAGE_SIZE = 20
+
+# How search results are ordered, for the UI and API to show
+ORDER = "newest"
+
+_WORD = re.compile(r"\w+")
+
+
+def words(text):
+    return _WORD.findall((text or '').lower())
+
+
+def terms(text):
+    """Return the index terms for a tweet's text."""
+    result = set()
+    for word in words(text):
+        result.add(word)
+        if INDEX_PREFIXES:
+            for length in range(MIN_PREFIX_LENGTH, len(word)):
+                result.add(word[:length])
+    return sorted(result)
+
+
+def query_terms(text):
+    # Query words are matched exactly; with prefix indexing that also covers partial words
+    return list(dict.fromkeys(words(text)))[:MAX_QUERY_TERMS]
+
+
+def search(db, text, user_id=None, cursor=None, page_size=PAGE_SIZE):
+    """Find tweets containing any word of text, by one user or by everyone.
+
+    Returns (tweets, next_cursor). Results are ordered by recency only: each
+    page is the page_size newest matches after cursor, newest first. Each
+    tweet's score is how many query words it contains, for display; ranking
+    by it within a page would reorder a slice of the results by relevance
+    while the pages themselves stay in date order.
+    """
+    wanted = query_terms(text)
+    if not wanted:
+        return [], None
+    if user_id:
+        source = db.collection('twitter_user').document(user_id).collection('tweets')
+    else:
+        source = db.collection_group('tweets')
+
+    # Collection group results can come from any user, so the cursor keeps the full path
+    query = cursors.newest_first(source.where(filter=FieldFilter(TERMS_FIELD, 'array_contains_any', wanted)),
+                                 page_size, cursor, db.document)
+    docs = list(query.stream())
+    next_cursor = None
+    if len(docs) == page_size:
+        last = docs[-1]
+        next_cursor = cursors.encode(last.get('date'), last.reference.path)
+
+    tweets = []
+    for doc in docs:
+        tweet = doc.to_dict()
+        tweet_terms = set(tweet.pop(TERMS_FIELD, []))
+        tweet['id'] = doc.id
+        tweet['tweetID'] = doc.id
+        tweet['userID'] = doc.reference.parent.parent.id
+        tweet['score'] = sum(1 for term in wanted if term in tweet_terms)
+        tweets.append(tweet)
+    return tweets, next_cursor
+
+
+def reindex(db, batch_size=500):
+    """Add search terms to tweets written before the index existed."""
+    batch = db.batch()
+    count = 0
+    for doc in db.collection_group('tweets').stream():
+        data = doc.to_dict()
+        if TERMS_FIELD in data:
+            continue
+        batch.update(doc.reference, {TERMS_FIELD: terms(data.get('tweetText'))})
+        count += 1
+        if count == batch_size:
+            batch.commit()
+            batch = db.batch()
+            count = 0
+    if count:
+        batch.commit()
@@ -0,0 +1,102 @@
+import bisect
+import hashlib
+import threading
+
+# Fields kept per user; the follow graph and everything else stays in Firestore
+USER_FIELDS = ('username', 'email', 'profile_url')
+
+# Default maximum number of users returned by a prefix search
+SEARCH_LIMIT = 50
+
+
+class UsernameDirectory:
+    """Process-local copy of every username, kept current by a snapshot listener.
+
+    Usernames are indexed in a sorted list of lowercased keys so prefix
+    searches are a binary search instead of a Firestore range query.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.users = {}
+        self.index = []
+        # Changes whenever any listed user changes, and is the same in every worker
+        self.version = 0
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.watch = None
+
+    def start(self, timeout=30):
+        """Subscribe to the users collection and wait for the initial load."""
+        with self.lock:
+            if self.watch is None:
+                self.watch = self.collection.on_snapshot(self._on_snapshot)
+        self.ready.wait(timeout)
+
+    def stop(self):
+        with self.lock:
+            if self.watch is not None:
+                self.watch.unsubscribe()
+                self.watch = None
+                self.ready.clear()
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self.lock:
+            for change in changes:
+                doc = change.document
+                self._remove(doc.id)
+                if change.type.name != 'REMOVED':
+                    self._add(doc.id, doc.to_dict() or {})
+        self.ready.set()
+
+    @staticmethod
+    def _digest(user):
+        # XOR of per-user digests, so adding and removing a user are both one step
+        raw = repr(sorted(user.items())).encode('utf-8')
+        return int.from_bytes(hashlib.sha1(raw).digest()[:8], 'big')
+
+    def _add(self, user_id, data):
+        user = {field: data.get(field, '') for field in USER_FIELDS}
+        user['id'] = user_id
+        self.users[user_id] = user
+        self.version ^= self._digest(user)
+        bisect.insort(self.index, ((user['username'] or '').lower(), user_id))
+
+    def _remove(self, user_id):
+        user = self.users.pop(user_id, None)
+        if user is not None:
+            self.version ^= self._digest(user)
+            key = ((user['username'] or '').lower(), user_id)
+            position = bisect.bisect_left(self.index, key)
+            if position < len(self.index) and self.index[position] == key:
+                del self.index[position]
+
+    def all(self):
+        """Return every user ordered by username."""
+        if not self.ready.is_set():
+            self.start()
+        with self.lock:
+            return [dict(self.users[user_id]) for _, user_id in self.index]
+
+    def search(self, prefix, limit=SEARCH_LIMIT):
+        """Return up to limit users whose username starts with prefix, ignoring case."""
+        if not self.ready.is_set():
+            self.start()
+        prefix = prefix.lower()
+        matches = []
+        with self.lock:
+            position = bisect.bisect_left(self.index, (prefix, ''))
+            while position < len(self.index) and len(matches) < limit:
+                key, user_id = self.index[position]
+                if not key.startswith(prefix):
+                    break
+                matches.append(dict(self.users[user_id]))
+                position += 1
+        return matches
+
+    def get(self, user_id):
+        if not self.ready.is_set():
+            self.start()
+        with self.lock:
+            user = self.users.get(user_id)
+            return dict(user) if user else None
@@ -0,0 +1,29 @@
+import time
+
+from shared_cache import Cache
+
+# Version stamps say when a part of a user's pages last changed:
+#   timeline:<id>  their home timeline
+#   profile:<id>   their user document, follows and followers
+#   tweets:<id>    the tweets they wrote
+# They live in the shared cache so a bump in one worker is seen by all of
+# them. A stamp that was evicted comes back as the current time, which only
+# costs the next view a full render.
+STAMP_TTL = 7 * 24 * 60 * 60
+
+stamps = Cache('version', STAMP_TTL)
+
+
+def bump(kind, *owner_ids):
+    """Mark kind as changed now for every owner, in one round trip."""
+    now = time.time()
+    stamps.set_many({kind + ':' + owner_id: now for owner_id in owner_ids})
+
+
+def read(*keys):
+    """Return the stamps for keys such as 'timeline:<id>', starting any that are missing."""
+    found = stamps.get_many(keys)
+    missing = {key: time.time() for key in keys if key not in found}
+    stamps.set_many(missing)
+    found.update(missing)
+    return [found[key] for key in keys]